@@ -0,0 +1,110 @@
+"""
+  Admission control for the routes which query the database.
+
+  When CockroachDB slows down, requests pile up in run_stmt()'s retries and sleeps, taking the
+  server's threads until nothing, not even a static file, is served.  Admission lets at
+  most max_concurrent such requests run at once, and max_queued more wait up to max_wait_s
+  for a turn; beyond that, or if a client has used up its token bucket (rate requests/s, up
+  to burst at once), Overloaded is raised at once, for the app to answer 503 (or 429) with
+  Retry-After, or with a stale answer if it has one.
+
+  Each admitted request has a deadline, deadline_s after it arrived; remaining_s() is what's
+  left of it, for the thread running the request, so the database work can be bounded by it
+  (see run_stmt() in map_app.py, which sets statement_timeout).
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+class Overloaded(Exception):
+  def __init__(self, reason, retry_after_s=1, status=503):
+    super().__init__(reason)
+    self.reason = reason
+    self.retry_after_s = retry_after_s
+    self.status = status
+
+class TokenBuckets:
+  """ A token bucket per client, for the most recently seen max_clients of them """
+  def __init__(self, rate, burst, max_clients=10000):
+    self.rate = rate
+    self.burst = burst
+    self.max_clients = max_clients
+    self.lock = threading.Lock()
+    self.buckets = OrderedDict() # client => [tokens, time last filled], least recently used first
+
+  # Takes a token for client; returns 0 if there was one, else the seconds until there will be
+  def take(self, client):
+    now = time.monotonic()
+    with self.lock:
+      b = self.buckets.get(client)
+      if b is None:
+        b = self.buckets[client] = [self.burst, now]
+        while len(self.buckets) > self.max_clients:
+          self.buckets.popitem(last=False)
+      else:
+        b[0] = min(self.burst, b[0] + (now - b[1]) * self.rate)
+        b[1] = now
+        self.buckets.move_to_end(client)
+      if b[0] >= 1:
+        b[0] -= 1
+        return 0
+      return (1 - b[0]) / self.rate
+
+class Admission:
+  def __init__(self, max_concurrent=8, max_queued=8, max_wait_s=1.0, deadline_s=5.0, rate=0, burst=20):
+    self.max_concurrent = max_concurrent
+    self.max_queued = max_queued
+    self.max_wait_s = max_wait_s
+    self.deadline_s = deadline_s
+    self.buckets = TokenBuckets(rate, burst) if rate > 0 else None
+    self.cond = threading.Condition() # An RLock, so _reject() can be called holding it
+    self.n_running = 0
+    self.n_waiting = 0
+    self.n_rejected = 0
+    self.local = threading.local()
+
+  def _reject(self, reason, retry_after_s=1, status=503):
+    with self.cond:
+      self.n_rejected += 1
+    raise Overloaded(reason, retry_after_s, status)
+
+  # Run the body of the with statement as a request from client, or raise Overloaded
+  @contextmanager
+  def admit(self, client):
+    deadline = time.monotonic() + self.deadline_s
+    if self.buckets is not None:
+      wait_s = self.buckets.take(client)
+      if wait_s > 0:
+        self._reject("rate limited", max(1, math.ceil(wait_s)), 429)
+    with self.cond:
+      if self.n_running >= self.max_concurrent:
+        if self.n_waiting >= self.max_queued:
+          self._reject("too many requests waiting")
+        self.n_waiting += 1
+        try:
+          # Not first come, first served: whichever waiter wakes first gets the turn
+          ok = self.cond.wait_for(lambda: self.n_running < self.max_concurrent,
+            timeout=min(self.max_wait_s, deadline - time.monotonic()))
+        finally:
+          self.n_waiting -= 1
+        if not ok:
+          self._reject("waited too long")
+      self.n_running += 1
+    self.local.deadline = deadline
+    try:
+      yield
+    finally:
+      self.local.deadline = None
+      with self.cond:
+        self.n_running -= 1
+        self.cond.notify()
+
+  # Seconds left before this thread's request's deadline, or None if it's not in one
+  def remaining_s(self):
+    deadline = getattr(self.local, "deadline", None)
+    if deadline is None:
+      return None
+    return deadline - time.monotonic()
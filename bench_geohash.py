@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+"""
+  Points/s for geohash encoding: geo_util.encode() on whole arrays versus one call per point
+  to Geohash.encode (map_app.py, the OSM scripts) and pygeohash.encode (load_geonames.py),
+  on the same random points.  The geohashes must all agree; the script checks that too.
+
+    $ ./bench_geohash.py 200000
+"""
+
+import sys
+import time
+import numpy as np
+import geo_util
+
+if len(sys.argv) > 1 and sys.argv[1] in ("-h", "--help"):
+  print("Usage: {} [n_points] [precision] [n_repeats]".format(sys.argv[0]))
+  sys.exit(1)
+
+n_points = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+precision = int(sys.argv[2]) if len(sys.argv) > 2 else 12
+n_repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+
+rnd = np.random.default_rng(42)
+lats = rnd.uniform(-89.9, 89.9, n_points)
+lons = rnd.uniform(-180.0, 180.0, n_points)
+
+def best_of(fn):
+  best = None
+  for i in range(n_repeats):
+    t0 = time.perf_counter()
+    rv = fn()
+    dt = time.perf_counter() - t0
+    best = dt if best is None else min(best, dt)
+  return (rv, n_points / best)
+
+results = []
+(ours, pps) = best_of(lambda: geo_util.encode(lats, lons, precision))
+results.append(("geo_util.encode", pps))
+lat_list = lats.tolist()
+lon_list = lons.tolist()
+
+try:
+  import Geohash
+  (theirs, pps) = best_of(lambda: [Geohash.encode(a, b, precision) for (a, b) in zip(lat_list, lon_list)])
+  results.append(("Geohash.encode", pps))
+  if theirs != ours.tolist():
+    print("Geohash.encode and geo_util.encode disagree")
+    sys.exit(1)
+except ImportError:
+  print("(Geohash not installed)")
+
+try:
+  import pygeohash as pgh
+  (theirs, pps) = best_of(lambda: [pgh.encode(a, b, precision) for (a, b) in zip(lat_list, lon_list)])
+  results.append(("pygeohash.encode", pps))
+  if theirs != ours.tolist():
+    print("pygeohash.encode and geo_util.encode disagree")
+    sys.exit(1)
+except ImportError:
+  print("(pygeohash not installed)")
+
+print("Points: {}, precision: {}".format(n_points, precision))
+for (name, pps) in results:
+  if name == "geo_util.encode":
+    print("{:18} {:>14,.0f} points/s".format(name + ':', pps))
+  else:
+    print("{:18} {:>14,.0f} points/s (geo_util.encode is {:.1f}x faster)".format(name + ':', pps, results[0][1] / pps))
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+"""
+  Micro-benchmark for the parsing stage of load_osm_stdin.py: lines/s for the original
+  parse loop (several regular expressions and a dict per row) versus osm_format.parse_line(),
+  on the same input.  Both produce the same rows; the script checks that too, and that the
+  loader's pipeline mode (osm_format.parse_chunk()) gives the same rows as parse_line().
+
+    $ ./gen_osm_data.py -n 200000 --bad-frac 0.01 -o /tmp/osm_200k.txt.gz
+    $ ./bench_osm_parse.py /tmp/osm_200k.txt.gz
+"""
+
+import gzip
+import html
+import re
+import sys
+import time
+from osm_format import N_COLS, OSM_COLS, parse_line, parse_chunk, pg_array, format_line
+
+if len(sys.argv) < 2:
+  print("Usage: {} data_file[.gz] [n_repeats]".format(sys.argv[0]))
+  sys.exit(1)
+
+# The parse loop of load_osm_stdin.py, as it was before osm_format.parse_line()
+llre = re.compile(r"^-?\d+\.\d+$")
+bad_re = re.compile(r"^N rows: \d+$")
+addr_pat = re.compile(r"^addr:(?:city|postcode|street)=(.+)$")
+
+def parse_line_orig(line):
+  line = line.rstrip()
+  if bad_re.match(line):
+    return None
+  a = line.split('<')
+  if N_COLS != len(a):
+    return None
+  (id, dt, uid, lat, lon, name, kvagg, geohash, rating, rating_ts) = a
+  if (not llre.match(lat)) or (not llre.match(lon)):
+    return None
+  kv = []
+  for w in re.split(r"\W+", name.lower()):
+    if len(w) > 0:
+      kv.append(w)
+  amenity = ""
+  search_hints = []
+  for x in kvagg.split('|'):
+    if len(x) == 0:
+      continue;
+    x = html.unescape(x)
+    x = re.sub(r"['\",{}]", "", x)
+    kv.append(x)
+    if x.startswith("amenity"):
+      amenity = x.split("=")[1]
+    else:
+      m = addr_pat.match(x)
+      if m is not None:
+        search_hints.append(m.group(1))
+  return {
+    "geohash4": geohash[:4],
+    "amenity": amenity,
+    "id": id,
+    "date_time": dt,
+    "uid": uid,
+    "name": html.unescape(name),
+    "lat": lat,
+    "lon": lon,
+    "key_value": kv,
+    "search_hints": ' '.join(search_hints),
+    "rating": rating if len(rating) > 0 else None,
+    "rating_ts": rating_ts if len(rating_ts) > 0 else None
+  }
+
+def run(fn, lines, n_repeats):
+  best = None
+  for i in range(n_repeats):
+    t0 = time.perf_counter()
+    for line in lines:
+      fn(line)
+    dt = time.perf_counter() - t0
+    best = dt if best is None else min(best, dt)
+  return len(lines) / best
+
+in_file = sys.argv[1]
+n_repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+opener = gzip.open if in_file.endswith(".gz") else open
+# Lines end with '\n' only, as they do for the loader reading stdin
+with opener(in_file, "rt", encoding="utf8", newline='\n') as f:
+  lines = f.readlines()
+
+# Same rows, in the same order, from both
+for line in lines:
+  d = parse_line_orig(line)
+  t = parse_line(line)
+  if (d is None) != (t is None) or (d is not None and tuple(d[c] for c in OSM_COLS) != t):
+    print("Mismatch for line: {}".format(line.rstrip()))
+    print("  original: {}".format(d))
+    print("  new:      {}".format(t))
+    sys.exit(1)
+
+# The loader's pipeline mode (parse_chunk()) gives the same rows as parse_line() on each line,
+# including for names with characters other than '\n' which str.splitlines() would split on
+odd_names = ["Bar\rNone", "Caf\u00e9\x85Luna", "Tab\x0bStop", "Form\x0cFeed", "Sep\x1cA\x1dB\x1eC",
+  "Line\u2028Sep", "Para\u2029Sep"]
+odd_lines = [format_line(1000 + i, "2020-01-01T00:00:00Z", 1, "51.5000000", "-0.1000000", name, ["amenity=pub"],
+  "gcpvj0du6", "", "") + '\n' for (i, name) in enumerate(odd_names)]
+kv_idx = OSM_COLS.index("key_value")
+for chunk_lines in (lines, odd_lines):
+  (n_lines, rows) = parse_chunk(''.join(chunk_lines).encode("utf8"))
+  expected = [t[:kv_idx] + (pg_array(t[kv_idx]),) + t[kv_idx + 1:] for t in map(parse_line, chunk_lines) if t is not None]
+  if n_lines != len(chunk_lines) or rows != expected:
+    print("parse_chunk(): {} lines, {} rows; expected {} lines, {} rows".format(n_lines, len(rows), len(chunk_lines),
+      len(expected)))
+    sys.exit(1)
+
+orig_lps = run(parse_line_orig, lines, n_repeats)
+new_lps = run(parse_line, lines, n_repeats)
+print("Lines: {}".format(len(lines)))
+print("Original parser: {:,.0f} lines/s".format(orig_lps))
+print("parse_line():    {:,.0f} lines/s ({:.2f}x)".format(new_lps, new_lps / orig_lps))
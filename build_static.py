@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+"""
+  Build the static assets the app serves from /assets: each file in static/ is copied to
+  assets/ under a name containing a hash of its content (leaflet.js => leaflet.0c8f1e3a9b.js),
+  along with gzip and brotli compressed copies (.gz, .br) of the text ones, and
+  assets/manifest.json maps each original name to its hashed one.
+
+  Since a hashed name always has the same content, map_app.py can tell browsers to cache it
+  for a year and never ask again; a changed file gets a new name, which the templates pick
+  up from the manifest (asset_url() in map_app.py).  The Dockerfile runs this; run it again
+  locally after changing anything in static/:
+
+    $ ./build_static.py
+
+  brotli is optional: without it only the .gz copies are made.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+here = os.path.dirname(os.path.abspath(__file__))
+src_dir = os.path.join(here, "static")
+out_dir = os.path.join(here, sys.argv[1] if len(sys.argv) > 1 else "assets")
+
+# Worth compressing; the PNGs already are
+compress_exts = (".js", ".css", ".map", ".json", ".svg", ".txt", ".html")
+
+def hashed_name(name, data):
+  (base, ext) = os.path.splitext(name)
+  return "{}.{}{}".format(base, hashlib.sha256(data).hexdigest()[:10], ext)
+
+def write(name, data):
+  with open(os.path.join(out_dir, name), "wb") as f:
+    f.write(data)
+
+if os.path.isdir(out_dir):
+  shutil.rmtree(out_dir)
+os.makedirs(out_dir)
+
+names = sorted(n for n in os.listdir(src_dir) if os.path.isfile(os.path.join(src_dir, n)))
+# Source maps first, so the files which refer to them can be pointed at their new names
+names.sort(key=lambda n: not n.endswith(".map"))
+manifest = {}
+n_in = n_gz = n_br = 0
+for name in names:
+  with open(os.path.join(src_dir, name), "rb") as f:
+    data = f.read()
+  if name.endswith((".js", ".css")):
+    def map_name(m):
+      ref = m.group(2).decode("utf8")
+      return m.group(1) + manifest.get(ref, ref).encode("utf8")
+    data = re.sub(rb"(sourceMappingURL=)([\w.\-]+)", map_name, data)
+  out_name = hashed_name(name, data)
+  manifest[name] = out_name
+  write(out_name, data)
+  n_in += len(data)
+  if name.endswith(compress_exts):
+    gz = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(gz) < len(data):
+      write(out_name + ".gz", gz)
+      n_gz += len(gz)
+    if brotli is not None:
+      br = brotli.compress(data, quality=11)
+      if len(br) < len(data):
+        write(out_name + ".br", br)
+        n_br += len(br)
+
+with open(os.path.join(out_dir, "manifest.json"), "w") as f:
+  json.dump(manifest, f, indent=2, sort_keys=True)
+print("{} files ({:,} bytes) => {}; gzip: {:,} bytes, brotli: {:,} bytes{}".format(len(manifest), n_in,
+  os.path.relpath(out_dir), n_gz, n_br, '' if brotli is not None else " (brotli not installed)"))
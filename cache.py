@@ -0,0 +1,54 @@
+"""
+  A small in-process cache with a time to live, for values which are read far more often than
+  they change and which can be a little stale (e.g. the logged in user's roles).  Each process
+  has its own, so a change made via another process or pod is seen within ttl_s, or at once if
+  the code making it calls invalidate().
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+class TTLCache:
+  def __init__(self, ttl_s=60, max_entries=10000):
+    self.ttl_s = ttl_s
+    self.max_entries = max_entries
+    self.lock = threading.Lock()
+    self.entries = OrderedDict() # key => (expires, value), least recently used first
+    self.n_hits = 0
+    self.n_misses = 0
+
+  # Returns the value, or None if it's missing or expired
+  def get(self, key):
+    now = time.time()
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None or entry[0] < now:
+        if entry is not None:
+          del self.entries[key]
+        self.n_misses += 1
+        return None
+      self.entries.move_to_end(key)
+      self.n_hits += 1
+      return entry[1]
+
+  def put(self, key, value):
+    with self.lock:
+      self.entries[key] = (time.time() + self.ttl_s, value)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+
+  def invalidate(self, key):
+    with self.lock:
+      self.entries.pop(key, None)
+
+  # Drops the entries for which fn(key, value) is true; a scan of them all, so for rare events
+  def invalidate_where(self, fn):
+    with self.lock:
+      for key in [k for (k, (expires, v)) in self.entries.items() if fn(k, v)]:
+        del self.entries[key]
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+"""
+  Check the query plans of the app's hot statements (queries.py), so a change which sends one
+  of them to a full scan, or to the wrong index, is caught before it reaches a cluster.
+
+  A synthetic fixture is loaded (gen_osm_data.py | load_osm_stdin.py, then map_app.py init-db
+  and some tourists, way points and positions), the tables are ANALYZEd, and each statement is
+  run under EXPLAIN ANALYZE, in a transaction which is rolled back.  For each, the check is that
+  the plan reads the index expected (e.g. /features with USE_GEOHASH=true must read osm@primary
+  by its (geohash4, amenity) prefixes; with USE_GEOHASH=false, osm@osm_geo_idx, since
+  key_value && ARRAY[...] has no index), has no full scan, and reads no more rows from KV than
+  the bound given, most of them counted from the fixture.  It prints a line per check, and the
+  plan of each which fails, and exits with 1 if any did.
+
+  Run it against a local single node, in a database of its own:
+
+    $ cockroach start-single-node --insecure --store=type=mem,size=4GiB --background
+    $ cockroach sql --insecure -e "CREATE DATABASE plan_check"
+    $ export DB_URL="postgres://root@localhost:26257/plan_check?sslmode=disable"
+    $ ./check_query_plans.py
+
+  The fixture is loaded only if osm is empty, so a rerun is quick; --reload drops and reloads it.
+"""
+
+import argparse
+import datetime
+import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+import sqlalchemy as sa
+from sqlalchemy import create_engine, text
+import geo_util
+import nearby
+import queries
+from osm_format import sites
+
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(message)s", datefmt="%m/%d/%Y %I:%M:%S %p")
+
+parser = argparse.ArgumentParser(description="EXPLAIN the app's hot statements against a synthetic fixture")
+parser.add_argument("-n", "--n-points", type=int, default=100000, help="Size of the osm fixture (gen_osm_data.py -n)")
+parser.add_argument("--seed", type=int, default=42, help="gen_osm_data.py --seed")
+parser.add_argument("--n-tourists", type=int, default=100, help="Synthetic Wayfinders, with way points and positions")
+parser.add_argument("--reload", action="store_true", help="Drop osm and load the fixture again")
+parser.add_argument("-v", "--verbose", action="store_true", help="Print every plan, not only the failures")
+args = parser.parse_args()
+
+db_url = os.getenv("DB_URL")
+if db_url is None:
+  print("Environment variable DB_URL must be set. Quitting.")
+  sys.exit(1)
+
+here = os.path.dirname(os.path.abspath(__file__))
+engine = create_engine(re.sub(r"^postgres(ql)?", "cockroachdb", db_url),
+  connect_args = { "application_name": "CRDB Geo Tourist Plan Check" })
+
+def scalar(sql, **params):
+  with engine.connect() as conn:
+    return conn.execute(text(sql).bindparams(**params)).scalar()
+
+def n_osm_rows():
+  try:
+    return scalar("SELECT count(*) FROM osm")
+  except sa.exc.ProgrammingError: # No osm table yet
+    return 0
+
+def load_fixture():
+  if args.reload:
+    with engine.begin() as conn:
+      conn.execute(text("DROP TABLE IF EXISTS osm"))
+  if n_osm_rows() == 0:
+    logging.info("Loading {} synthetic osm rows".format(args.n_points))
+    gen = subprocess.Popen([sys.executable, "gen_osm_data.py", "-n", str(args.n_points), "--seed", str(args.seed)],
+      cwd=here, stdout=subprocess.PIPE)
+    subprocess.run([sys.executable, "load_osm_stdin.py"], cwd=here, stdin=gen.stdout, check=True)
+    gen.stdout.close()
+    if gen.wait() != 0:
+      raise Exception("gen_osm_data.py failed")
+  subprocess.run([sys.executable, "map_app.py", "init-db"], cwd=here, check=True)
+  if scalar("SELECT count(*) FROM tourist WHERE username LIKE 'plan_check_%'") == 0:
+    load_tourists()
+  for table in ("osm", "tourist", "tourist_role", "role", "way_point", "way_point_trail", "tourist_position"):
+    with engine.begin() as conn:
+      conn.execute(text('ANALYZE "{}"'.format(table)))
+  logging.info("Fixture: {} osm rows".format(n_osm_rows()))
+
+# Wayfinders, each with two days of way points (one per 5 minutes), four weeks of compacted
+# trail before that (one per hour), and an hour of positions around one of the sites
+def load_tourists():
+  logging.info("Adding {} tourists".format(args.n_tourists))
+  with engine.begin() as conn:
+    conn.execute(text("""
+    INSERT INTO tourist (username, email)
+    SELECT 'plan_check_' || i, 'plan_check_' || i || '@example.com' FROM generate_series(1, :n) AS g (i)
+    """).bindparams(n=args.n_tourists))
+    conn.execute(text("""
+    INSERT INTO tourist_role (tourist_id, role_id)
+    SELECT t.id, r.id FROM tourist t, "role" r WHERE t.username LIKE 'plan_check_%' AND r.name = 'Wayfinder'
+    """))
+    conn.execute(text("""
+    INSERT INTO way_point (tourist_id, ts, lat, lon)
+    SELECT t.id, now()::TIMESTAMP - g * INTERVAL '5 minutes', 51.5 + random() / 100, -0.13 + random() / 100
+    FROM tourist t, generate_series(0, 575) AS g WHERE t.username LIKE 'plan_check_%'
+    """))
+    conn.execute(text("""
+    INSERT INTO way_point_trail (tourist_id, ts, lat, lon)
+    SELECT t.id, now()::TIMESTAMP - INTERVAL '2 days' - g * INTERVAL '1 hour', 51.5 + random() / 100, -0.13 + random() / 100
+    FROM tourist t, generate_series(0, 671) AS g WHERE t.username LIKE 'plan_check_%'
+    """))
+    rnd = random.Random(args.seed)
+    now = time.time()
+    rows = []
+    tourists = conn.execute(text("SELECT id, username FROM tourist WHERE username LIKE 'plan_check_%'")).all()
+    for (i, (tid, username)) in enumerate(tourists):
+      s = sites[i % len(sites)]
+      for k in range(12):
+        ts = now - k * 300
+        (lat, lon) = (s["lat"] + rnd.uniform(-0.02, 0.02), s["lon"] + rnd.uniform(-0.02, 0.02))
+        rows.append({
+          "geohash5": geo_util.encode_one(lat, lon, nearby.CELL_PRECISION),
+          "time_bucket": datetime.datetime.utcfromtimestamp(nearby.time_bucket(ts, 300)),
+          "tourist_id": tid,
+          "username": username,
+          "ts": datetime.datetime.utcfromtimestamp(ts),
+          "lat": lat,
+          "lon": lon
+        })
+    conn.execute(text(queries.upsert_position_sql), rows)
+
+n_failed = 0
+
+def check(name, sql, params, index, max_rows, full_scan_ok=()):
+  """
+  EXPLAIN ANALYZE sql, and check that it reads index (table@index), scans no table in full
+  (except those in full_scan_ok) and reads at most max_rows rows from KV
+  """
+  global n_failed
+  with engine.connect() as conn:
+    plan = "\n".join(row[0] for row in conn.execute(text("EXPLAIN ANALYZE " + sql).bindparams(**params)))
+    conn.rollback() # The writes are carried out, then undone
+  indexes = re.findall(r"table: (\S+)", plan)
+  m = re.search(r"rows (?:read|decoded) from KV: ([\d,]+)", plan)
+  n_rows = int(m.group(1).replace(',', '')) if m else 0 # Left out if there were none
+  errors = []
+  if index not in indexes:
+    errors.append("doesn't read {}".format(index))
+  for (table_index, spans) in re.findall(r"table: (\S+)[^\n]*\n[^\n]*?spans: (FULL SCAN)", plan):
+    if table_index.split('@')[0] not in full_scan_ok:
+      errors.append("full scan of {}".format(table_index))
+  if n_rows > max_rows:
+    errors.append("read {:,} rows, more than {:,}".format(n_rows, max_rows))
+  print("{:34} {:8} {:>9} {:>9}  {}".format(name, "FAIL" if errors else "ok", "{:,}".format(n_rows),
+    "{:,}".format(max_rows), ", ".join(errors) or ", ".join(sorted(set(indexes)))))
+  if errors or args.verbose:
+    print(plan + "\n")
+  if errors:
+    n_failed += 1
+
+load_fixture()
+
+print("{:34} {:8} {:>9} {:>9}  {}".format("statement", "result", "rows read", "bound", "indexes / errors"))
+for (site, amenity) in ((sites[1], "pub"), (sites[4], "restaurant"), (sites[10], "cafe")):
+  (lat, lon) = (site["lat"], site["lon"])
+  cells = geo_util.cover_circle(lat, lon, 5.0E+03, 4)
+  # All the rows in the (geohash4, amenity) prefixes searched
+  n = scalar("SELECT count(*) FROM osm WHERE geohash4 = ANY (:cells) AND amenity = :amenity", cells=cells, amenity=amenity)
+  check("features geohash {} {}".format(site["name"][:10], amenity), queries.features_sql(True),
+    { "lon_val": lon, "lat_val": lat, "cells": cells, "amenity": amenity }, "osm@primary", int(n * 1.1) + 10)
+  # The index entries for the circle, plus the rows they point to, are within twice its size
+  n = scalar("SELECT count(*) FROM osm WHERE ST_DWithin(ST_MakePoint(:lon, :lat)::GEOGRAPHY, ref_point, 1.0E+04, TRUE)",
+    lon=lon, lat=lat)
+  check("features geo_idx {} {}".format(site["name"][:10], amenity), queries.features_sql(False),
+    { "lon_val": lon, "lat_val": lat, "amenity": "amenity=" + amenity }, "osm@osm_geo_idx", 2 * n + 100)
+
+(tid, username) = (scalar("SELECT id FROM tourist WHERE username = 'plan_check_1'"), "plan_check_1")
+check("user", queries.user_sql, { "id": tid }, "tourist@tourist_pkey", 20, full_scan_ok=("role",))
+check("sites", queries.sites_sql, {}, "tourist_locations@primary", 1000, full_scan_ok=("tourist_locations",))
+
+now = time.time()
+site = sites[1]
+cells = geo_util.cover_circle(site["lat"], site["lon"], 2000, nearby.CELL_PRECISION)
+n = scalar("SELECT count(*) FROM tourist_position WHERE geohash5 = ANY (:cells)", cells=cells)
+check("nearby", queries.nearby_sql, {
+  "cells": cells,
+  "min_bucket": datetime.datetime.utcfromtimestamp(nearby.time_bucket(now - 600, 300)),
+  "min_ts": datetime.datetime.utcfromtimestamp(now - 600),
+  "me": tid
+}, "tourist_position@tourist_position_pkey", n + 10)
+check("upsert position", queries.upsert_position_sql, {
+  "geohash5": geo_util.encode_one(site["lat"], site["lon"], nearby.CELL_PRECISION),
+  "time_bucket": datetime.datetime.utcfromtimestamp(nearby.time_bucket(now, 300)),
+  "tourist_id": tid,
+  "username": username,
+  "ts": datetime.datetime.utcfromtimestamp(now),
+  "lat": site["lat"],
+  "lon": site["lon"]
+}, "tourist_position@tourist_position_pkey", 10)
+
+for hours in (24, 24 * 7):
+  min_ts = datetime.datetime.utcnow() - datetime.timedelta(hours=hours)
+  n = scalar("SELECT count(*) FROM way_point WHERE tourist_id = :me AND ts >= :min_ts", me=tid, min_ts=min_ts) \
+    + scalar("SELECT count(*) FROM way_point_trail WHERE tourist_id = :me AND ts >= :min_ts", me=tid, min_ts=min_ts)
+  check("trail {} h".format(hours), queries.trail_sql, { "me": tid, "min_ts": min_ts, "max_points": 5000 },
+    "way_point@way_point_pkey", n + 10)
+
+# Edits, of rows in the cell of Trafalgar Square
+cell = geo_util.encode_one(sites[1]["lat"], sites[1]["lon"], 4)
+with engine.connect() as conn:
+  keys = conn.execute(text("SELECT geohash4, amenity, id FROM osm WHERE geohash4 = :cell LIMIT 200").bindparams(cell=cell)).all()
+(geohash4, amenity, id) = keys[0]
+check("amenity", queries.amenity_sql, { "geohash4": geohash4, "amenity": amenity, "id": id }, "osm@primary", 1)
+check("edit", queries.edit_sql, { "rating": 4.5, "name": "Plan Check", "geohash4": geohash4, "amenity": amenity, "id": id },
+  "osm@primary", 2)
+edits = [(g, a, i, True, 4.0, False, None) for (g, a, i) in keys]
+check("bulk edit x {}".format(len(edits)), queries.bulk_update_sql(len(edits)), queries.bulk_update_params(edits),
+  "osm@primary", 2 * len(edits))
+
+if n_failed > 0:
+  print("{} check(s) failed".format(n_failed))
+  sys.exit(1)
+print("All checks passed")
@@ -103,5 +103,50 @@ CREATE TABLE public.way_point
   CONSTRAINT way_point_pkey PRIMARY KEY (tourist_id ASC, ts ASC),
   CONSTRAINT way_point_tourist_id_fkey FOREIGN KEY (tourist_id) REFERENCES public.tourist(id)
 )
+WITH (ttl_expire_after = '7 days', ttl_job_cron = '@daily')
 LOCALITY REGIONAL BY ROW;
 
+/*
+  Raw way points older than a day are downsampled into way_point_trail, then deleted, by
+  compact_way_points.py; the TTL above only catches what that job misses.
+ */
+CREATE TABLE public.way_point_trail
+(
+  tourist_id UUID NOT NULL,
+  ts TIMESTAMP NOT NULL,
+  lat FLOAT8 NOT NULL,
+  lon FLOAT8 NOT NULL,
+  CONSTRAINT way_point_trail_pkey PRIMARY KEY (tourist_id ASC, ts ASC),
+  CONSTRAINT way_point_trail_tourist_id_fkey FOREIGN KEY (tourist_id) REFERENCES public.tourist(id)
+)
+LOCALITY REGIONAL BY ROW;
+
+
+/*
+  Last known position of each tourist, per geohash5 cell and time bucket (see nearby.py), so
+  "who is near me" reads the few cells and buckets covering the query instead of scanning
+  way_point.  Written with UPSERT, and homed in the region of its cell, like osm.  Rows expire
+  an hour after their last write.
+ */
+CREATE TABLE public.tourist_position
+(
+  geohash5 STRING NOT NULL,
+  time_bucket TIMESTAMP NOT NULL,
+  tourist_id UUID NOT NULL,
+  username VARCHAR(64) NOT NULL,
+  ts TIMESTAMP NOT NULL,
+  lat FLOAT8 NOT NULL,
+  lon FLOAT8 NOT NULL,
+  crdb_region crdb_internal_region NOT VISIBLE NOT NULL AS
+  (
+    CASE
+      WHEN SUBSTRING(geohash5 FROM 1 FOR 1) IN ('9') THEN 'gcp-us-central1'
+      WHEN SUBSTRING(geohash5 FROM 1 FOR 1) IN ('u', 'g', 'e', 's') THEN 'gcp-europe-west1'
+      ELSE 'gcp-us-east1'
+    END
+  ) STORED,
+  CONSTRAINT tourist_position_pkey PRIMARY KEY (geohash5 ASC, time_bucket ASC, tourist_id ASC),
+  CONSTRAINT tourist_position_tourist_id_fkey FOREIGN KEY (tourist_id) REFERENCES public.tourist(id)
+)
+WITH (ttl_expire_after = '1 hour', ttl_job_cron = '*/10 * * * *')
+LOCALITY REGIONAL BY ROW;
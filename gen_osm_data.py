@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+"""
+  Generate a synthetic OSM data set, in the '<' delimited format load_osm_stdin.py reads,
+  so the loader and the map queries can be benchmarked on a laptop without downloading
+  the extracts listed in k8s/data-loader.yaml.
+
+  Points are clustered around the tourist sites (osm_format.sites), with the rest scattered
+  across a bounding box, and the amenity mix is configurable.  The output is a pure function
+  of the arguments, so a given --seed always produces the same file.
+
+  Examples:
+
+    # A 100k point fixture: 80% of points within ~2 km of a site, the rest across Europe
+    $ ./gen_osm_data.py -n 100000 --seed 42 | gzip - > osm_synthetic_100k.txt.gz
+
+    # Load it into a local cluster
+    $ gunzip -c osm_synthetic_100k.txt.gz | ./load_osm_stdin.py
+
+    # Pubs only, tightly clustered, with a few malformed lines to exercise the parser
+    $ ./gen_osm_data.py -n 20000 --amenities pub=1 --radius-km 0.5 --bad-frac 0.01 -o pubs.txt.gz
+"""
+
+import argparse
+import datetime
+import gzip
+import math
+import random
+import sys
+import geo_util
+from osm_format import format_line, sites
+
+# The area of the planet extract in osm/planet_osm_extract.sh
+default_bbox = "72.253800,-12.666450,33.120960,34.225994" # top, left, bottom, right
+
+name_first = ["The", "Old", "Red", "Royal", "Golden", "Little", "Crown", "Black", "White", "Green",
+  "King's", "Queen's", "Café", "Le", "La", "Il", "Zum", "Bar", "Casa", "Blue"]
+name_second = ["Lion", "Anchor", "Swan", "Bell", "Oak", "Harp", "Rose", "Star", "Plough", "Bridge",
+  "Fountain", "Mill", "Market", "Corner", "Garden", "Kitchen", "Table", "Bistro", "Hirsch", "Luna"]
+# A few names with characters which are escaped in the OSM XML
+name_special = ["Bellini&apos;s", "Fish &amp; Chips", "O&apos;Neill&apos;s", "Rock &amp; Roll"]
+streets = ["High Street", "Market Street", "Church Lane", "Station Road", "Main Street", "Rue de Rivoli",
+  "Via della Lungaretta", "Calle de Atocha", "Maximilianstraße", "Bank Street"]
+extra_tags = ["wheelchair=yes", "wheelchair=limited", "outdoor_seating=yes", "food=yes", "real_ale=yes",
+  "opening_hours=Mo-Su 11:00-23:00", "cuisine=italian", "cuisine=coffee_shop", "toilets=yes"]
+
+def parse_mix(s):
+  mix = []
+  for kv in s.split(','):
+    (k, v) = kv.split('=')
+    mix.append((k.strip(), float(v)))
+  return mix
+
+# A point at a random distance (normally distributed, sigma = radius_km) and bearing from (lat, lon)
+def near(rnd, lat, lon, radius_km):
+  d = abs(rnd.gauss(0, radius_km)) / 6371.0
+  theta = rnd.uniform(0, 2 * math.pi)
+  lat1 = math.radians(lat)
+  lat2 = math.asin(math.sin(lat1) * math.cos(d) + math.cos(lat1) * math.sin(d) * math.cos(theta))
+  lon2 = math.radians(lon) + math.atan2(math.sin(theta) * math.sin(d) * math.cos(lat1),
+    math.cos(d) - math.sin(lat1) * math.sin(lat2))
+  return (math.degrees(lat2), (math.degrees(lon2) + 540) % 360 - 180)
+
+def gen_name(rnd):
+  if rnd.random() < 0.02:
+    return rnd.choice(name_special)
+  return rnd.choice(name_first) + ' ' + rnd.choice(name_second)
+
+def gen_lines(args, batch_size=10000):
+  rnd = random.Random(args.seed)
+  (top, left, bottom, right) = [float(x) for x in args.bbox.split(',')]
+  amenities = [a for (a, w) in args.amenities]
+  amenity_weights = [w for (a, w) in args.amenities]
+  t_start = datetime.datetime(2015, 1, 1, tzinfo=datetime.timezone.utc)
+  t_span = 9 * 365 * 86400
+  # Points are generated a batch at a time, so their geohashes can be computed in one go
+  batch = []
+  for n in range(args.n_points):
+    if rnd.random() < args.bad_frac:
+      # What the Perl extract script prints to stdout now and then
+      batch.append("N rows: {}".format(n))
+      continue
+    if rnd.random() < args.hotspot_frac:
+      s = rnd.choice(sites)
+      (lat, lon) = near(rnd, s["lat"], s["lon"], args.radius_km)
+      city = s["name"]
+    else:
+      lat = rnd.uniform(bottom, top)
+      lon = rnd.uniform(left, right)
+      city = "Synthetic"
+    amenity = rnd.choices(amenities, amenity_weights)[0]
+    tags = []
+    if rnd.random() < 0.6:
+      tags.append("addr:city=" + city)
+    if rnd.random() < 0.4:
+      tags.append("addr:postcode={}{} {}{}".format(rnd.choice("ABCDEFGHJKLMNPRSTUWYZ"), rnd.randint(1, 20),
+        rnd.randint(1, 9), rnd.choice("ABDEFGHJLNPQRSTUWXYZ") * 2))
+    if rnd.random() < 0.7:
+      tags.append("addr:street=" + rnd.choice(streets))
+    tags.append("amenity=" + amenity)
+    tags.extend(rnd.sample(extra_tags, rnd.randint(0, 3)))
+    tags.sort()
+    dt = (t_start + datetime.timedelta(seconds=rnd.randrange(t_span))).strftime("%Y-%m-%dT%H:%M:%SZ")
+    rating = ""
+    rating_ts = ""
+    if rnd.random() < args.rated_frac:
+      rating = "{:.1f}".format(rnd.randint(2, 10) / 2)
+      rating_ts = (t_start + datetime.timedelta(seconds=t_span + rnd.randrange(86400 * 365))).replace(tzinfo=None).isoformat()
+    batch.append((args.first_id + n, dt, rnd.randint(1, 20000000), lat, lon, gen_name(rnd), tags, rating, rating_ts))
+    if len(batch) >= batch_size:
+      yield from format_batch(batch)
+      batch = []
+  yield from format_batch(batch)
+
+def format_batch(batch):
+  points = [p for p in batch if not isinstance(p, str)]
+  geohashes = iter(geo_util.encode([p[3] for p in points], [p[4] for p in points]).tolist()) if points else None
+  for p in batch:
+    if isinstance(p, str):
+      yield p
+      continue
+    (id, dt, uid, lat, lon, name, tags, rating, rating_ts) = p
+    yield format_line(id, dt, uid, "{:.7f}".format(lat), "{:.7f}".format(lon), name, tags, next(geohashes),
+      rating, rating_ts)
+
+def main():
+  parser = argparse.ArgumentParser(description="Generate a synthetic OSM data file for load_osm_stdin.py")
+  parser.add_argument("-n", "--n-points", type=int, default=100000, help="Number of lines to generate")
+  parser.add_argument("--seed", type=int, default=42, help="Random seed; the same seed gives the same file")
+  parser.add_argument("--hotspot-frac", type=float, default=0.8, help="Fraction of points placed near a site")
+  parser.add_argument("--radius-km", type=float, default=2.0, help="Spread (std. dev.) of points around each site")
+  parser.add_argument("--amenities", type=parse_mix, default="restaurant=4,cafe=3,pub=2,bar=2,fast_food=1,bench=1",
+    help="Amenity mix, as amenity=weight,...")
+  parser.add_argument("--bbox", default=default_bbox, help="top,left,bottom,right for points not near a site")
+  parser.add_argument("--rated-frac", type=float, default=0.5, help="Fraction of points which have a rating")
+  parser.add_argument("--bad-frac", type=float, default=0.0, help="Fraction of malformed lines to emit")
+  parser.add_argument("--first-id", type=int, default=1000000000, help="OSM id of the first point")
+  parser.add_argument("-o", "--output", help="Output file (gzip'd if it ends with .gz); default is stdout")
+  args = parser.parse_args()
+
+  out = sys.stdout
+  if args.output is not None:
+    if args.output.endswith(".gz"):
+      out = gzip.open(args.output, "wt", encoding="utf8")
+    else:
+      out = open(args.output, 'w', encoding="utf8")
+  for line in gen_lines(args):
+    out.write(line + '\n')
+  if out is not sys.stdout:
+    out.close()
+
+if __name__ == "__main__":
+  main()
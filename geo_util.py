@@ -0,0 +1,184 @@
+"""
+  Geohash and bounding box helpers, vectorized with NumPy so the loaders can encode a whole
+  batch of points in one call rather than one Geohash.encode() per point:
+
+  * encode(lats, lons): geohashes for arrays of points (the same strings Geohash.encode gives)
+  * decode(hashes): cell centres, and the cells' half widths
+  * neighbors(geohash): the 8 cells around one cell
+  * cover_bbox(), cover_circle(): the cells of a given length which cover an area, e.g. for
+    geohash4 = ANY (...) predicates
+  * bbox(lats, lons), coords_bbox(coords): (top, left, bottom, right) over coordinate arrays
+
+  Cells are handled as integer (lat, lon) indexes on the grid of cells of a given length, so
+  everything other than the base32 conversion is plain integer arithmetic.
+
+  bench_geohash.py compares encode() with the per-point libraries.
+"""
+
+import math
+import numpy as np
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+MAX_PRECISION = 12 # 60 bits: fits a uint64
+
+_chars = np.frombuffer(BASE32.encode("ascii"), dtype=np.uint8)
+_values = np.full(256, 255, dtype=np.uint8)
+_values[_chars] = np.arange(32, dtype=np.uint8)
+
+EARTH_RADIUS_M = 6371008.8
+
+# Bits of longitude and of latitude in a geohash of this many characters
+def _n_bits(precision):
+  n = 5 * precision
+  return ((n + 1) // 2, n // 2)
+
+# Spread the low 32 bits of x out to the even bit positions of a uint64
+def _spread(x):
+  x = x.astype(np.uint64) & np.uint64(0xFFFFFFFF)
+  for (shift, mask) in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+      (2, 0x3333333333333333), (1, 0x5555555555555555)):
+    x = (x | (x << np.uint64(shift))) & np.uint64(mask)
+  return x
+
+# The inverse of _spread(): gather the even bits of x
+def _compact(x):
+  x = x & np.uint64(0x5555555555555555)
+  for (shift, mask) in ((1, 0x3333333333333333), (2, 0x0F0F0F0F0F0F0F0F), (4, 0x00FF00FF00FF00FF),
+      (8, 0x0000FFFF0000FFFF), (16, 0x00000000FFFFFFFF)):
+    x = (x | (x >> np.uint64(shift))) & np.uint64(mask)
+  return x
+
+def _check_precision(precision):
+  if not 1 <= precision <= MAX_PRECISION:
+    raise ValueError("precision must be between 1 and {}".format(MAX_PRECISION))
+
+def cell_index(lats, lons, precision=MAX_PRECISION):
+  """ The (lat, lon) integer indexes of the cells containing the points """
+  _check_precision(precision)
+  (lon_bits, lat_bits) = _n_bits(precision)
+  lats = np.asarray(lats, dtype=np.float64)
+  lons = np.asarray(lons, dtype=np.float64)
+  lat_i = np.floor((lats + 90.0) / 180.0 * (1 << lat_bits)).astype(np.int64)
+  lon_i = np.floor((lons + 180.0) / 360.0 * (1 << lon_bits)).astype(np.int64)
+  # lat = 90 belongs to the last cell; lon = 180 is lon = -180, as with Geohash.encode
+  return (np.clip(lat_i, 0, (1 << lat_bits) - 1), lon_i % (1 << lon_bits))
+
+def from_index(lat_i, lon_i, precision):
+  """ Geohashes for arrays of (lat, lon) cell indexes """
+  (lon_bits, lat_bits) = _n_bits(precision)
+  lat_i = np.asarray(lat_i, dtype=np.int64)
+  lon_i = np.asarray(lon_i, dtype=np.int64)
+  # The first bit is longitude, then they alternate; the last is longitude if there's an odd number
+  if lon_bits > lat_bits:
+    code = _spread(lon_i) | (_spread(lat_i) << np.uint64(1))
+  else:
+    code = (_spread(lon_i) << np.uint64(1)) | _spread(lat_i)
+  shifts = np.arange(5 * (precision - 1), -1, -5, dtype=np.uint64)
+  digits = (code[..., None] >> shifts) & np.uint64(31)
+  ascii = np.ascontiguousarray(_chars[digits.astype(np.intp)])
+  return ascii.view("S{}".format(precision))[..., 0].astype("U{}".format(precision))
+
+def to_index(hashes):
+  """ The (lat, lon) cell indexes and precision of geohashes, which must all be the same length """
+  hashes = np.asarray(hashes)
+  precision = hashes.dtype.itemsize // (4 if hashes.dtype.kind == 'U' else 1)
+  _check_precision(precision)
+  ascii = np.ascontiguousarray(hashes.astype("S{}".format(precision))).view(np.uint8)
+  digits = _values[ascii].reshape(hashes.shape + (precision,))
+  if (digits == 255).any():
+    raise ValueError("Invalid geohash character")
+  code = np.zeros(hashes.shape, dtype=np.uint64)
+  for i in range(precision):
+    code = (code << np.uint64(5)) | digits[..., i].astype(np.uint64)
+  (lon_bits, lat_bits) = _n_bits(precision)
+  if lon_bits > lat_bits:
+    (lon_i, lat_i) = (_compact(code), _compact(code >> np.uint64(1)))
+  else:
+    (lon_i, lat_i) = (_compact(code >> np.uint64(1)), _compact(code))
+  return (lat_i.astype(np.int64), lon_i.astype(np.int64), precision)
+
+def encode(lats, lons, precision=MAX_PRECISION):
+  """ Geohashes for arrays of points, as an array of str """
+  (lat_i, lon_i) = cell_index(lats, lons, precision)
+  return from_index(lat_i, lon_i, precision)
+
+def encode_one(lat, lon, precision=MAX_PRECISION):
+  return str(encode([lat], [lon], precision)[0])
+
+def decode(hashes):
+  """ (lats, lons, lat_errs, lon_errs): the centres of the cells and their half heights / widths """
+  (lat_i, lon_i, precision) = to_index(hashes)
+  (lon_bits, lat_bits) = _n_bits(precision)
+  lat_h = 180.0 / (1 << lat_bits)
+  lon_w = 360.0 / (1 << lon_bits)
+  return ((lat_i + 0.5) * lat_h - 90.0, (lon_i + 0.5) * lon_w - 180.0, lat_h / 2, lon_w / 2)
+
+def neighbors(geohash):
+  """ The cells around geohash, as [n, ne, e, se, s, sw, w, nw]; None beyond a pole """
+  (lat_i, lon_i, precision) = to_index(np.array([geohash]))
+  (lat_i, lon_i) = (int(lat_i[0]), int(lon_i[0]))
+  (lon_bits, lat_bits) = _n_bits(precision)
+  rv = []
+  for (d_lat, d_lon) in ((1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1)):
+    lat_n = lat_i + d_lat
+    if lat_n < 0 or lat_n >= (1 << lat_bits):
+      rv.append(None)
+      continue
+    rv.append(str(from_index([lat_n], [(lon_i + d_lon) % (1 << lon_bits)], precision)[0]))
+  return rv
+
+def cover_bbox(top, left, bottom, right, precision):
+  """ The cells which together cover a bounding box; left > right means it crosses 180 degrees """
+  (lon_bits, lat_bits) = _n_bits(precision)
+  (lat_lo, lon_lo) = cell_index([bottom], [left], precision)
+  (lat_hi, lon_hi) = cell_index([top], [right], precision)
+  (lon_lo, lon_hi) = (int(lon_lo[0]), int(lon_hi[0]))
+  if right >= 180.0: # Not wrapped round to -180, here
+    lon_hi = (1 << lon_bits) - 1
+  lat_r = np.arange(lat_lo[0], lat_hi[0] + 1)
+  if left <= right:
+    lon_r = np.arange(lon_lo, lon_hi + 1)
+  else:
+    lon_r = np.concatenate([np.arange(lon_lo, 1 << lon_bits), np.arange(0, lon_hi + 1)])
+  (lat_g, lon_g) = np.meshgrid(lat_r, lon_r, indexing="ij")
+  return from_index(lat_g.ravel(), lon_g.ravel(), precision).tolist()
+
+def cover_circle(lat, lon, radius_m, precision):
+  """ The cells which intersect a circle of radius_m metres around (lat, lon) """
+  d_lat = math.degrees(radius_m / EARTH_RADIUS_M)
+  top = min(lat + d_lat, 90.0)
+  bottom = max(lat - d_lat, -90.0)
+  if top >= 90.0 or bottom <= -90.0:
+    (left, right) = (-180.0, 180.0)
+  else:
+    d_lon = math.degrees(radius_m / (EARTH_RADIUS_M * math.cos(math.radians(max(abs(top), abs(bottom))))))
+    if d_lon >= 180.0:
+      (left, right) = (-180.0, 180.0)
+    else:
+      left = (lon - d_lon + 180.0) % 360.0 - 180.0
+      right = (lon + d_lon + 180.0) % 360.0 - 180.0
+  cells = np.array(cover_bbox(top, left, bottom, right, precision))
+  if len(cells) <= 1:
+    return cells.tolist()
+  # Drop the corner cells the circle doesn't reach: distance to the nearest point of each cell
+  (c_lat, c_lon, h_lat, h_lon) = decode(cells)
+  n_lat = np.clip(lat, c_lat - h_lat, c_lat + h_lat)
+  dl = (lon - c_lon + 180.0) % 360.0 - 180.0 # Signed, across 180 degrees
+  n_lon = lon - dl + np.clip(dl, -h_lon, h_lon)
+  return cells[haversine_m(lat, lon, n_lat, n_lon) <= radius_m].tolist()
+
+def haversine_m(lat1, lon1, lat2, lon2):
+  (lat1, lon1, lat2, lon2) = (np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2))
+  a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+  return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def bbox(lats, lons):
+  """ (top, left, bottom, right) of arrays of points """
+  lats = np.asarray(lats, dtype=np.float64)
+  lons = np.asarray(lons, dtype=np.float64)
+  return (float(lats.max()), float(lons.min()), float(lats.min()), float(lons.max()))
+
+def coords_bbox(coords):
+  """ (top, left, bottom, right) of GeoJSON style coordinates: a list of [lon, lat] pairs (or a list of such lists) """
+  a = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+  return bbox(a[:, 1], a[:, 0])
@@ -0,0 +1,38 @@
+"""
+  Run map_app.py in several processes, so /features isn't limited to one core by the GIL:
+
+    $ export WEB_CONCURRENCY=4  # Worker processes; the default is one per core
+    $ gunicorn -c gunicorn.conf.py
+
+  The app is imported once, in the master, then forked (preload_app), so the workers share
+  its code and its SECRET_KEY.  Each worker drops the connections it inherited and starts
+  its own pool prewarm (and changefeed, if LIVE_UPDATES=changefeed).  POOL_SIZE is the
+  pod's budget per pool, divided among the workers (but at least 1 each, so keep it at least
+  WEB_CONCURRENCY), with no overflow unless POOL_MAX_OVERFLOW is set; set the number of
+  workers with WEB_CONCURRENCY rather than -w, since the pools are sized when the app is
+  imported.
+
+  Each process has its own live update broker and nearby index, so with more than one
+  worker use LIVE_UPDATES=changefeed and NEARBY_SOURCE=db.
+"""
+
+import multiprocessing
+import os
+
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+os.environ["WEB_CONCURRENCY"] = str(workers) # Read by map_app.py, to size its pools
+
+wsgi_app = "map_app:app"
+preload_app = True
+bind = "0.0.0.0:{}".format(os.getenv("FLASK_PORT", "18080"))
+worker_class = "gthread"
+# Per worker: the live update streams hold one thread each, and 8 more serve the rest; map_app.py
+# sizes admission control to fit these and its pools
+live_max_streams = int(os.getenv("LIVE_MAX_STREAMS", "64"))
+threads = int(os.getenv("GUNICORN_THREADS", str(live_max_streams + 8)))
+os.environ["GUNICORN_THREADS"] = str(threads) # Read by map_app.py
+
+def post_fork(server, worker):
+  import map_app
+  map_app.reset_pools()
+  map_app.create_app()
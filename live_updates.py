@@ -0,0 +1,196 @@
+"""
+  Live updates of osm rows, pushed to open maps as server-sent events (SSE).
+
+  One Broker per process fans each change out to the clients subscribed to its geohash4
+  cell.  Changes reach the Broker one of two ways (LIVE_UPDATES):
+
+    * publish:    map_app.py publishes each edit it makes itself (the default).  Each pod
+                  only sees its own edits, which is fine for a single pod.
+    * changefeed: a thread runs a core changefeed on the osm table and publishes every
+                  change, from any pod or any other writer (e.g. osm/refresh_ratings.py).
+                  It starts from now (no initial scan of the table) and, after an error,
+                  resumes from the last resolved timestamp it saw, so nothing is replayed
+                  but the few seconds before it.
+                  This needs: SET CLUSTER SETTING kv.rangefeed.enabled = true;
+    * off:        no /features/live endpoint.
+
+  Each open stream holds one of the server's threads, waiting on its queue, so LIVE_MAX_STREAMS
+  caps how many are open at once (map_app.py sizes the thread pool to fit them) and each is
+  closed after LIVE_STREAM_S seconds; the client reconnects.
+"""
+
+import json
+import logging
+import queue
+import random
+import threading
+import time
+import psycopg2
+
+class Subscription:
+  def __init__(self, broker, cells, max_queued):
+    self.broker = broker
+    self.cells = set(cells)
+    self.q = queue.Queue(maxsize=max_queued)
+    self.n_dropped = 0
+  def put(self, event):
+    try:
+      self.q.put_nowait(event)
+    except queue.Full:
+      self.n_dropped += 1 # A client this far behind will refetch anyway
+  # Returns the next event, or None after timeout_s
+  def get(self, timeout_s):
+    try:
+      return self.q.get(timeout=timeout_s)
+    except queue.Empty:
+      return None
+  def close(self):
+    self.broker.unsubscribe(self)
+
+class Broker:
+  """ geohash4 cell -> subscriptions; publish() costs a dict lookup plus one put per subscriber """
+  def __init__(self, max_streams=4, max_queued=100):
+    self.max_streams = max_streams
+    self.max_queued = max_queued
+    self.lock = threading.Lock()
+    self.by_cell = {}
+    self.n_streams = 0
+  # Returns a Subscription, or None if there are already max_streams
+  def subscribe(self, cells):
+    with self.lock:
+      if self.n_streams >= self.max_streams:
+        return None
+      self.n_streams += 1
+      sub = Subscription(self, cells, self.max_queued)
+      for c in sub.cells:
+        self.by_cell.setdefault(c, set()).add(sub)
+    return sub
+  def unsubscribe(self, sub):
+    with self.lock:
+      self.n_streams -= 1
+      for c in sub.cells:
+        subs = self.by_cell.get(c)
+        if subs is not None:
+          subs.discard(sub)
+          if len(subs) == 0:
+            del self.by_cell[c]
+  def publish(self, event):
+    with self.lock:
+      subs = list(self.by_cell.get(event["geohash4"], ()))
+    for sub in subs:
+      sub.put(event)
+
+def sse_stream(sub, stream_s, keepalive_s=15):
+  """
+  Yield the subscription's events in SSE format for stream_s seconds, with a comment line
+  every keepalive_s so proxies don't drop an idle connection
+  """
+  try:
+    yield "retry: 2000\n\n"
+    t_end = time.time() + stream_s
+    while True:
+      t_left = t_end - time.time()
+      if t_left <= 0:
+        return
+      event = sub.get(min(keepalive_s, t_left))
+      if event is None:
+        yield ": keepalive\n\n"
+      else:
+        yield "event: osm\ndata: {}\n\n".format(json.dumps(event))
+  finally:
+    sub.close()
+
+# The fields of an osm row which are sent to clients
+event_fields = ("geohash4", "amenity", "id", "name", "rating", "lat", "lon")
+
+def row_event(row):
+  return { k: row.get(k) for k in event_fields }
+
+class Stopped(Exception):
+  pass
+
+class ChangefeedWriter:
+  """
+  The file object that COPY (EXPERIMENTAL CHANGEFEED FOR osm) TO STDOUT writes to: lines of
+  table, key and value, tab separated in COPY text format, where the value is the JSON
+  envelope {"after": {...}} (after is null for a DELETE, which isn't published).  The rows
+  with no table are resolved timestamps, {"resolved": "<HLC>"}: every change before one has
+  been written, so the last is where to resume from.  Once stop is set, the next write raises
+  Stopped, which ends the COPY: with a resolved timestamp every resolved_interval, that's soon.
+  """
+  def __init__(self, broker, stop=None):
+    self.broker = broker
+    self.stop = stop
+    self.buf = ''
+    self.resolved = None
+  def write(self, data):
+    if self.stop is not None and self.stop.is_set():
+      raise Stopped()
+    if isinstance(data, bytes):
+      data = data.decode("utf8")
+    self.buf += data
+    *lines, self.buf = self.buf.split('\n')
+    for line in lines:
+      cols = line.split('\t')
+      if len(cols) < 3 or cols[2] == "\\N":
+        continue
+      value = json.loads(unescape_copy(cols[2]))
+      if value.get("resolved") is not None:
+        self.resolved = value["resolved"]
+      elif value.get("after") is not None:
+        self.broker.publish(row_event(value["after"]))
+
+def unescape_copy(s):
+  if '\\' not in s:
+    return s
+  out = []
+  i = 0
+  while i < len(s):
+    c = s[i]
+    if c == '\\' and i + 1 < len(s):
+      i += 1
+      c = { 'n': '\n', 't': '\t', 'r': '\r' }.get(s[i], s[i])
+    out.append(c)
+    i += 1
+  return ''.join(out)
+
+# How often the changefeed emits a resolved timestamp, and how old one may be to resume from;
+# an older one may be past the table's GC threshold, and is too much to replay anyway
+resolved_interval = "10s"
+max_resume_age_s = 600
+
+def changefeed_sql(cursor):
+  """ The changefeed statement, from cursor (a resolved timestamp) if there is one, else from now """
+  if cursor is not None and time.time() - int(cursor.split('.')[0]) / 1.0E+09 < max_resume_age_s:
+    opts = "resolved = '{}', cursor = '{}'".format(resolved_interval, cursor)
+  else:
+    opts = "resolved = '{}', no_initial_scan".format(resolved_interval)
+  return "COPY (EXPERIMENTAL CHANGEFEED FOR osm WITH {}) TO STDOUT".format(opts)
+
+def run_changefeed(broker, dsn, stop):
+  """ Stream changes to osm into broker until stop is set, reconnecting on errors """
+  writer = ChangefeedWriter(broker, stop)
+  while not stop.is_set():
+    conn = None
+    try:
+      conn = psycopg2.connect(dsn, application_name="CRDB Geo Tourist CHANGEFEED")
+      conn.autocommit = True
+      sql = changefeed_sql(writer.resolved)
+      logging.info("Changefeed on osm: started (%s)", "from " + writer.resolved if "cursor" in sql else "from now")
+      writer.buf = ''
+      with conn.cursor() as cur:
+        cur.copy_expert(sql, writer)
+    except Stopped:
+      logging.info("Changefeed on osm: stopped")
+    except psycopg2.Error as e:
+      logging.warning("Changefeed on osm: %s", e)
+    finally:
+      if conn is not None:
+        conn.close()
+    stop.wait(1 + random.random() * 4)
+
+def start_changefeed(broker, dsn):
+  stop = threading.Event()
+  t = threading.Thread(target=run_changefeed, args=(broker, dsn, stop), name="osm-changefeed", daemon=True)
+  t.start()
+  return stop
@@ -2,16 +2,19 @@
 
 import psycopg2
 import psycopg2.errorcodes
+import psycopg2.extras
 import sqlalchemy
-from sqlalchemy import create_engine, insert, text
-from sqlalchemy import Table, MetaData
+from sqlalchemy import create_engine, text
 import time
 import sys, os
-import gzip
-import html
 import re
+import random
 import fileinput
 import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from osm_format import OSM_COLS, parse_line, parse_chunk, read_chunks, sites
 
 """
  $ sudo apt install python3-pip
@@ -35,31 +38,19 @@ logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(message)s", date
 #
 # curl -s -k http://localhost:8000/osm_1m_eu.txt.gz | gunzip - | ./load_osm_stdin.py
 #
-
-N_COLS = 10 # Number of columns in the input data set
+# Pipeline mode: parse in PARSE_WORKERS processes, reading the input in chunks of CHUNK_KB.
+# PARSE_ORDERED=false lets batches reach the INSERT stage as soon as they're parsed, rather
+# than in input order.  At most MAX_CHUNKS_IN_FLIGHT chunks are read ahead, to bound memory.
+#
+#   export PARSE_WORKERS=4
+#
 
 rows_per_batch = 2048 # Edit as necessary
 
-# This is the list of sites where our "tourist" will initially appear upon a page load
-sites = []
-sites.append({"name": "British Museum", "lat": 51.519844, "lon": -0.126731})
-sites.append({"name": "Trafalgar Square", "lat": 51.506712, "lon": -0.127235})
-sites.append({"name": "Tate Modern", "lat": 51.508337, "lon": -0.099281})
-sites.append({"name": "Dublin", "lat": 53.346028, "lon": -6.279658})
-sites.append({"name": "Munich", "lat": 48.135056, "lon": 11.576097})
-sites.append({"name": "Le Marais", "lat": 48.857744, "lon": 2.357768})
-sites.append({"name": "Trastevere", "lat": 41.886071, "lon": 12.467422})
-sites.append({"name": "Prado Museum", "lat": 40.41367, "lon": -3.69185})
-sites.append({"name": "Mercado Antón Martín", "lat": 40.41170, "lon": -3.69850})
-sites.append({"name": "Kyiv", "lat": 50.4474203, "lon": 30.5265874})
-sites.append({"name": "Austin", "lat": 30.260721, "lon": -97.747101})
-sites.append({"name": "Charlottesville", "lat": 38.0311977, "lon": -78.4829433})
-sites.append({"name": "Madison Square Park", "lat": 40.742348, "lon": -73.988355})
-sites.append({"name": "Dupont Circle", "lat": 38.9100535, "lon": -77.0426321})
-sites.append({"name": "Laguna Beach", "lat": 33.5418456, "lon": -117.7838984})
-sites.append({"name": "Westwood", "lat": 34.0620851, "lon": -118.4428635})
-sites.append({"name": "Pasadena", "lat": 34.1390904, "lon": -118.1277370})
-sites.append({"name": "Orlando", "lat": 28.5458843, "lon": -81.3760205})
+parse_workers = int(os.getenv("PARSE_WORKERS", "0"))
+parse_ordered = os.getenv("PARSE_ORDERED", "true").lower() == "true"
+chunk_bytes = 1024 * int(os.getenv("CHUNK_KB", "4096"))
+max_chunks_in_flight = int(os.getenv("MAX_CHUNKS_IN_FLIGHT", str(2 * max(parse_workers, 1))))
 
 max_retries = int(os.getenv("MAX_RETRIES", "3"))
 logging.info("MAX_RETRIES: {}".format(max_retries))
@@ -70,12 +61,18 @@ logging.info("DB_CONN_STR (rewritten): {}".format(db_url))
 engine = create_engine(db_url, connect_args = { "application_name": "OSM Data Loader" })
 logging.info("Engine: OK")
 
-def do_inserts(list_of_row_maps):
+# One multi-row INSERT per batch; the rows are tuples in OSM_COLS order (see osm_format.py).
+# key_value is either a list or, from parse_chunk(), an array literal; the cast covers both.
+insert_sql = "INSERT INTO osm ({}) VALUES %s".format(", ".join(OSM_COLS))
+insert_template = "({})".format(", ".join("%s::TEXT[]" if c == "key_value" else "%s" for c in OSM_COLS))
+
+def do_inserts(list_of_rows):
   for retry in range(1, max_retries + 1):
     try:
       with engine.begin() as conn:
-        # https://docs.sqlalchemy.org/en/14/tutorial/data_insert.html
-        conn.execute(insert(osm_table), list_of_row_maps)
+        with conn.connection.cursor() as cur:
+          psycopg2.extras.execute_values(cur, insert_sql, list_of_rows, template=insert_template,
+            page_size=len(list_of_rows))
       return
     except sqlalchemy.exc.OperationalError as e: # This handles dead nodes
       logging.warning(e)
@@ -146,84 +143,80 @@ def setup_db():
       stmt = text(sql).bindparams(name=s["name"], lat=s["lat"], lon=s["lon"])
       conn.execute(stmt)
 
+# Parse the chunks in a pool of processes, yielding (n_lines, rows) for each chunk
+def parse_parallel(chunks):
+  # The workers only parse, so they don't touch the engine inherited from this process
+  ctx = multiprocessing.get_context("fork")
+  with ProcessPoolExecutor(max_workers=parse_workers, mp_context=ctx) as pool:
+    if parse_ordered:
+      pending = deque()
+      for chunk in chunks:
+        pending.append(pool.submit(parse_chunk, chunk))
+        while len(pending) >= max_chunks_in_flight:
+          yield pending.popleft().result()
+      while len(pending) > 0:
+        yield pending.popleft().result()
+    else:
+      pending = set()
+      for chunk in chunks:
+        pending.add(pool.submit(parse_chunk, chunk))
+        while len(pending) >= max_chunks_in_flight:
+          (done, pending) = wait(pending, return_when=FIRST_COMPLETED)
+          for fut in done:
+            yield fut.result()
+      for fut in pending:
+        yield fut.result()
+
+# All the input, as in fileinput.input(), but in chunks of whole lines
+def input_chunks():
+  files = sys.argv[1:] if len(sys.argv) > 1 else ['-']
+  for fname in files:
+    if fname == '-':
+      yield from read_chunks(sys.stdin.buffer, chunk_bytes)
+    else:
+      with open(fname, "rb") as f:
+        yield from read_chunks(f, chunk_bytes)
+
 rows = []
-llre = re.compile(r"^-?\d+\.\d+$")
-bad_re = re.compile(r"^N rows: \d+$")
 n_rows_ins = 0 # Rows inserted
 n_line = 0 # Position in input file
 n_batch = 1
 
 setup_db()
 
-# Table "osm" must exist
-osm_table = Table("osm", MetaData(), autoload_with=engine)
-
-# Use any of these entities as search_hints
-addr_pat = re.compile(r"^addr:(?:city|postcode|street)=(.+)$")
-
-for line in fileinput.input():
-  line = line.rstrip()
-  n_line += 1
-  # Get past malformed lines due to printing row counts to stdout in Perl data prep script :-o
-  if bad_re.match(line):
-    continue
-  # 78347 <2018-08-09T22:29:35Z <366321 <63.4305942 <10.3921538 <Prinsenkrysset <highway=traffic_signals|u5r|u5r2|u5r2u|u5r2u7 <u5r2u7pmfxz8b
-  a = line.split('<')
-  if N_COLS != len(a):
-    continue
-  (id, dt, uid, lat, lon, name, kvagg, geohash, rating, rating_ts) = a
-  # (lat, lon) may have this format: 54°05.131'..., which is bogus
-  if (not llre.match(lat)) or (not llre.match(lon)):
-    continue
-  # Clean up all the kv data
-  kv = []
-  # Add the words in the name onto kv
-  for w in re.split(r"\W+", name.lower()):
-    if len(w) > 0:
-      kv.append(w)
-  amenity = ""
-  search_hints = []
-  for x in kvagg.split('|'):
-    if len(x) == 0:
-      continue;
-    x = html.unescape(x)
-    x = re.sub(r"['\",{}]", "", x)
-    kv.append(x)
-    if x.startswith("amenity"):
-      amenity = x.split("=")[1]
-    # Location details: postcode, street, city
-    # Example: addr:postcode=GU27 3HA|addr:street=Midhurst Road
-    else:
-      m = addr_pat.match(x)
-      if m is not None:
-        search_hints.append(m.group(1))
-  row_map = {
-    "geohash4": geohash[:4],
-    "amenity": amenity,
-    "id": id,
-    "date_time": dt,
-    "uid": uid,
-    "name": html.unescape(name),
-    "lat": lat,
-    "lon": lon,
-    "key_value": kv,
-    "search_hints": ' '.join(search_hints),
-    "rating": rating if len(rating) > 0 else None,
-    "rating_ts": rating_ts if len(rating_ts) > 0 else None
-  }
-  rows.append(row_map)
-  if len(rows) % rows_per_batch == 0:
-    logging.info("Running INSERT for batch %d of %d rows" % (n_batch, rows_per_batch))
+def flush_batches(final=False):
+  global n_rows_ins, n_batch
+  n = 0 # Rows taken from the front of rows
+  while len(rows) - n >= rows_per_batch or (final and n < len(rows)):
+    batch = rows[n:n + rows_per_batch]
+    n += len(batch)
+    logging.info("Running INSERT for batch %d of %d rows" % (n_batch, len(batch)))
     t0 = time.time()
-    do_inserts(rows)
-    n_rows_ins += rows_per_batch
-    rows.clear()
+    do_inserts(batch)
+    n_rows_ins += len(batch)
     t1 = time.time()
-    logging.info("INSERT for batch %d of %d rows took %.2f s" % (n_batch, rows_per_batch, t1 - t0))
+    logging.info("INSERT for batch %d of %d rows took %.2f s" % (n_batch, len(batch), t1 - t0))
     n_batch += 1
+  del rows[:n]
+
+if parse_workers > 0:
+  logging.info("Parsing with %d processes (ordered: %s)", parse_workers, parse_ordered)
+  for (n, chunk_rows) in parse_parallel(input_chunks()):
+    n_line += n
+    rows.extend(chunk_rows)
+    flush_batches()
+else:
+  for line in fileinput.input():
+    n_line += 1
+    # 78347 <2018-08-09T22:29:35Z <366321 <63.4305942 <10.3921538 <Prinsenkrysset <highway=traffic_signals|u5r|u5r2|u5r2u|u5r2u7 <u5r2u7pmfxz8b
+    row = parse_line(line)
+    if row is None:
+      continue
+    rows.append(row)
+    if len(rows) == rows_per_batch:
+      flush_batches()
 
 # Last bit
-if len(rows) > 0:
-  do_inserts(rows)
-  n_rows_ins += len(rows)
+flush_batches(final=True)
+logging.info("Read %d lines, inserted %d rows", n_line, n_rows_ins)
 
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+"""
+  Load generator and latency benchmark for the map API (/sites and /features).
+
+  Each simulated tourist runs a session which resembles what the Leaflet page does:
+    * GET /sites to pick one of the enabled tourist_locations
+    * POST /features for a random amenity at that location
+    * A series of pans (small random moves of the map center), each followed by a POST /features
+    * Occasionally switch to another amenity, as the context menu does
+
+  Sessions are either anonymous or logged in as one of the users given via --user,
+  so Wayfinder (way_point writes) and Grand Tourist (edit links) paths get exercised.
+  Those users must already exist and have the relevant roles.
+
+  The summary (p50/p95/p99 latency, throughput, error rate and bytes per endpoint)
+  is written as JSON, so runs with different settings (USE_GEOHASH, pool sizes, ...)
+  can be compared; use --label to tag each run.
+
+  Examples:
+
+    $ ./load_test.py --url http://localhost:18080 --concurrency 20 --duration 60 --label geohash
+    $ ./load_test.py --concurrency 50 --sessions 500 --user wayfinder:secret --user grand:secret -o run.json
+
+  --format columns asks /features for its compact format, and --accept-encoding lets the
+  server compress responses; mean_bytes is then what came over the wire, and
+  mean_decoded_bytes its size once decompressed (brotli is decoded only if the brotli module
+  is installed):
+
+    $ ./load_test.py --label plain -o plain.json
+    $ ./load_test.py --format columns --accept-encoding gzip --label columns-gzip -o columns-gzip.json
+
+  Only the Python standard library is used, apart from that.
+"""
+
+import argparse
+import gzip
+import http.cookiejar
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(message)s", datefmt="%m/%d/%Y %I:%M:%S %p")
+
+amenity_types = ["restaurant", "pub", "cafe", "bar"]
+
+# The Accept header for each --format of /features response
+format_types = { "json": "application/json", "columns": "application/vnd.geotourist.columns+json" }
+
+# The Flask-WTF CSRF token rendered into the login form
+csrf_pat = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+# Metres per degree of latitude (close enough for panning around)
+M_PER_DEG = 111320.0
+
+class Stats:
+  """ Thread safe collection of per-endpoint request timings """
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.latencies = {} # endpoint => [seconds, ...]
+    self.errors = {} # endpoint => count
+    self.n_bytes = {} # endpoint => bytes received
+    self.n_decoded = {} # endpoint => bytes received, once decompressed
+    self.statuses = {} # status code => count
+  def record(self, endpoint, elapsed, status, n_bytes, ok, n_decoded=None):
+    with self.lock:
+      self.latencies.setdefault(endpoint, []).append(elapsed)
+      self.n_bytes[endpoint] = self.n_bytes.get(endpoint, 0) + n_bytes
+      self.n_decoded[endpoint] = self.n_decoded.get(endpoint, 0) + (n_bytes if n_decoded is None else n_decoded)
+      self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+      if not ok:
+        self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+def percentile(sorted_vals, pct):
+  if len(sorted_vals) == 0:
+    return None
+  k = max(0, int(math.ceil(pct / 100.0 * len(sorted_vals))) - 1)
+  return sorted_vals[k]
+
+def summarize(stats, elapsed_s, args):
+  endpoints = {}
+  all_lat = []
+  n_err = 0
+  for ep, lat in stats.latencies.items():
+    s = sorted(lat)
+    all_lat.extend(s)
+    errs = stats.errors.get(ep, 0)
+    n_err += errs
+    endpoints[ep] = {
+      "requests": len(s),
+      "errors": errs,
+      "error_rate": errs / len(s),
+      "throughput_rps": len(s) / elapsed_s,
+      "p50_ms": 1000 * percentile(s, 50),
+      "p95_ms": 1000 * percentile(s, 95),
+      "p99_ms": 1000 * percentile(s, 99),
+      "max_ms": 1000 * s[-1],
+      "mean_bytes": stats.n_bytes.get(ep, 0) / len(s),
+      "mean_decoded_bytes": stats.n_decoded.get(ep, 0) / len(s)
+    }
+  all_lat.sort()
+  n_req = len(all_lat)
+  return {
+    "label": args.label,
+    "url": args.url,
+    "concurrency": args.concurrency,
+    "format": args.format,
+    "accept_encoding": args.accept_encoding,
+    "elapsed_s": elapsed_s,
+    "requests": n_req,
+    "errors": n_err,
+    "error_rate": (n_err / n_req) if n_req > 0 else None,
+    "throughput_rps": n_req / elapsed_s,
+    "p50_ms": 1000 * percentile(all_lat, 50) if n_req > 0 else None,
+    "p95_ms": 1000 * percentile(all_lat, 95) if n_req > 0 else None,
+    "p99_ms": 1000 * percentile(all_lat, 99) if n_req > 0 else None,
+    "statuses": stats.statuses,
+    "endpoints": endpoints
+  }
+
+class Session:
+  """ One simulated tourist, with its own cookie jar """
+  def __init__(self, args, stats, rnd, user=None):
+    self.args = args
+    self.stats = stats
+    self.rnd = rnd
+    self.user = user
+    self.opener = urllib.request.build_opener(
+      urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+  def request(self, endpoint, path, data=None, headers={}, record=True):
+    req = urllib.request.Request(self.args.url + path, data=data, headers=headers)
+    t0 = time.time()
+    status = 0
+    body = b""
+    encoding = None
+    try:
+      with self.opener.open(req, timeout=self.args.timeout) as r:
+        status = r.status
+        body = r.read()
+        encoding = r.headers.get("Content-Encoding")
+    except urllib.error.HTTPError as e:
+      status = e.code
+      body = e.read()
+    except Exception as e: # Timeouts, refused connections, ...
+      logging.debug("%s: %s", endpoint, e)
+    elapsed = time.time() - t0
+    n_bytes = len(body)
+    if encoding == "gzip":
+      body = gzip.decompress(body)
+    elif encoding == "br" and brotli is not None:
+      body = brotli.decompress(body)
+    if record:
+      self.stats.record(endpoint, elapsed, status, n_bytes, 200 <= status < 400, len(body))
+    return (status, body)
+  def login(self):
+    (username, password) = self.user
+    (status, body) = self.request("login", "/login", record=False)
+    mat = csrf_pat.search(body.decode("utf8", "replace"))
+    form = { "username": username, "password": password, "lat": "", "lon": "", "zoom": "" }
+    if mat is not None:
+      form["csrf_token"] = mat.group(1)
+    data = urllib.parse.urlencode(form).encode("utf8")
+    (status, body) = self.request("login", "/login", data=data,
+      headers={ "Content-Type": "application/x-www-form-urlencoded" })
+    return 200 <= status < 400
+  def sites(self):
+    (status, body) = self.request("sites", "/sites")
+    try:
+      obj = json.loads(body)
+      return (float(obj["lat"]), float(obj.get("lng", obj.get("lon"))))
+    except (ValueError, KeyError, TypeError):
+      return (51.506712, -0.127235)
+  def features(self, lat, lon, amenity):
+    obj = { "amenity": amenity, "lat": lat, "lon": lon, "zoom": 16 }
+    headers = { "Content-Type": "application/json; charset=utf-8", "Accept": format_types[self.args.format] }
+    if self.args.accept_encoding is not None:
+      headers["Accept-Encoding"] = self.args.accept_encoding
+    self.request("features", "/features", data=json.dumps(obj).encode("utf8"), headers=headers)
+  def run(self):
+    if self.user is not None and not self.login():
+      logging.warning("Login failed for %s", self.user[0])
+    (lat, lon) = self.sites()
+    amenity = self.rnd.choice(amenity_types)
+    self.features(lat, lon, amenity)
+    for i in range(self.args.pans):
+      if self.args.think_ms > 0:
+        time.sleep(self.rnd.uniform(0, 2 * self.args.think_ms) / 1000)
+      # Move the map center by up to pan_m metres in each direction
+      dlat = self.rnd.uniform(-self.args.pan_m, self.args.pan_m) / M_PER_DEG
+      dlon = self.rnd.uniform(-self.args.pan_m, self.args.pan_m) / (M_PER_DEG * math.cos(math.radians(lat)))
+      lat += dlat
+      lon += dlon
+      if self.rnd.random() < self.args.switch_prob:
+        amenity = self.rnd.choice(amenity_types)
+      self.features(lat, lon, amenity)
+
+def worker(n, args, stats, deadline, counter):
+  rnd = random.Random(None if args.seed is None else args.seed + n)
+  while time.time() < deadline:
+    with counter["lock"]:
+      if args.sessions is not None and counter["started"] >= args.sessions:
+        return
+      counter["started"] += 1
+    user = None
+    if len(args.users) > 0 and rnd.random() < args.login_frac:
+      user = rnd.choice(args.users)
+    Session(args, stats, rnd, user).run()
+
+def parse_user(s):
+  if ':' not in s:
+    raise argparse.ArgumentTypeError("expected username:password, got '{}'".format(s))
+  return tuple(s.split(':', 1))
+
+def main():
+  parser = argparse.ArgumentParser(description="Drive /sites and /features with simulated tourist sessions")
+  parser.add_argument("--url", default="http://localhost:18080", help="Base URL of map_app.py")
+  parser.add_argument("-c", "--concurrency", type=int, default=10, help="Concurrent sessions")
+  parser.add_argument("-d", "--duration", type=float, default=30, help="Run time limit, in seconds")
+  parser.add_argument("-n", "--sessions", type=int, help="Stop after this many sessions")
+  parser.add_argument("--pans", type=int, default=5, help="Pans (each with a /features call) per session")
+  parser.add_argument("--pan-m", type=float, default=300, help="Max. distance per pan, in metres")
+  parser.add_argument("--switch-prob", type=float, default=0.2, help="Chance of switching amenity on each pan")
+  parser.add_argument("--think-ms", type=float, default=0, help="Mean pause between requests in a session")
+  parser.add_argument("--user", dest="users", type=parse_user, action="append", default=[],
+    help="username:password of an existing user (e.g. a Wayfinder or Grand Tourist); repeatable")
+  parser.add_argument("--login-frac", type=float, default=0.5, help="Fraction of sessions which log in, when --user is given")
+  parser.add_argument("--format", choices=sorted(format_types), default="json", help="/features response format")
+  parser.add_argument("--accept-encoding", help="Accept-Encoding for /features, e.g. 'gzip' or 'br, gzip'")
+  parser.add_argument("--timeout", type=float, default=10, help="Per request timeout, in seconds")
+  parser.add_argument("--seed", type=int, help="Random seed, for repeatable sessions")
+  parser.add_argument("--label", default="", help="Free form tag for this run (e.g. 'geohash, pool_size=10')")
+  parser.add_argument("-o", "--output", help="Write the JSON summary here instead of stdout")
+  args = parser.parse_args()
+  args.url = args.url.rstrip('/')
+
+  stats = Stats()
+  counter = { "lock": threading.Lock(), "started": 0 }
+  logging.info("Running %d concurrent sessions against %s for up to %.0f s", args.concurrency, args.url, args.duration)
+  t0 = time.time()
+  deadline = t0 + args.duration
+  threads = [threading.Thread(target=worker, args=(n, args, stats, deadline, counter), daemon=True)
+    for n in range(args.concurrency)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  elapsed_s = time.time() - t0
+
+  rv = summarize(stats, elapsed_s, args)
+  rv["sessions"] = counter["started"]
+  logging.info("%d requests in %.1f s: %.1f req/s, p50 %s ms, p99 %s ms, %d errors", rv["requests"], elapsed_s,
+    rv["throughput_rps"], rv["p50_ms"], rv["p99_ms"], rv["errors"])
+  if args.output is not None:
+    with open(args.output, 'w') as f:
+      f.write(json.dumps(rv, indent=2) + '\n')
+  else:
+    print(json.dumps(rv, indent=2))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,76 @@
+"""
+  Last known positions of tourists, for "who is near me right now" (/tourists/nearby).
+
+  way_point is keyed by (tourist_id, ts), so answering that from it means a full scan.
+  Instead, each way point also updates:
+
+    * NearbyIndex: in memory, the latest position of each tourist, bucketed by geohash5 cell.
+      A query looks at the few cells covering the search circle, so its cost depends on how
+      many tourists are nearby, not on how many there are.
+    * the tourist_position table: one row per (geohash5, time bucket, tourist), written with
+      UPSERT, so every pod can answer from the cells and buckets covering the query; old
+      buckets expire by row-level TTL (see ddl_iam_multi-region.sql).
+"""
+
+import threading
+import time
+import geo_util
+
+CELL_PRECISION = 5 # geohash5: about 4.9 km x 4.9 km
+
+class NearbyIndex:
+  def __init__(self, max_age_s=600):
+    self.max_age_s = max_age_s
+    self.lock = threading.Lock()
+    self.cells = {} # geohash5 => { tourist_id: (ts, lat, lon, username) }
+    self.cell_of = {} # tourist_id => geohash5
+    self.n_updates = 0
+
+  def update(self, tourist_id, username, lat, lon, ts=None):
+    ts = time.time() if ts is None else ts
+    cell = geo_util.encode_one(lat, lon, CELL_PRECISION)
+    with self.lock:
+      old = self.cell_of.get(tourist_id)
+      if old is not None and old != cell:
+        self._remove(old, tourist_id)
+      self.cells.setdefault(cell, {})[tourist_id] = (ts, lat, lon, username)
+      self.cell_of[tourist_id] = cell
+      self.n_updates += 1
+      if self.n_updates % 1000 == 0:
+        self._prune(ts)
+
+  def _remove(self, cell, tourist_id):
+    entries = self.cells.get(cell)
+    if entries is not None:
+      entries.pop(tourist_id, None)
+      if len(entries) == 0:
+        del self.cells[cell]
+
+  # Drop the tourists not seen for max_age_s
+  def _prune(self, now):
+    for cell in list(self.cells):
+      for (tourist_id, entry) in list(self.cells[cell].items()):
+        if now - entry[0] > self.max_age_s:
+          self._remove(cell, tourist_id)
+          del self.cell_of[tourist_id]
+
+  def query(self, lat, lon, radius_m, max_age_s=None, exclude=None, limit=50):
+    """ [(dist_m, age_s, tourist_id, username, lat, lon)] within radius_m, nearest first """
+    now = time.time()
+    max_age_s = self.max_age_s if max_age_s is None else min(max_age_s, self.max_age_s)
+    found = []
+    with self.lock:
+      for cell in geo_util.cover_circle(lat, lon, radius_m, CELL_PRECISION):
+        for (tourist_id, (ts, t_lat, t_lon, username)) in self.cells.get(cell, {}).items():
+          if tourist_id != exclude and now - ts <= max_age_s:
+            found.append((tourist_id, username, t_lat, t_lon, now - ts))
+    if len(found) == 0:
+      return []
+    dists = geo_util.haversine_m(lat, lon, [f[2] for f in found], [f[3] for f in found]).tolist()
+    rv = [(d, age, tid, name, t_lat, t_lon) for ((tid, name, t_lat, t_lon, age), d) in zip(found, dists) if d <= radius_m]
+    rv.sort(key=lambda r: r[0])
+    return rv[:limit]
+
+def time_bucket(ts, bucket_s):
+  """ The start of ts's time bucket, as epoch seconds """
+  return ts - ts % bucket_s
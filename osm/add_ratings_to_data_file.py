@@ -12,131 +12,141 @@
     -H "Accept-Encoding: gzip" \
     -H "X-Subscription-Token: $( cat ./Brave_Search_API_Key.txt )"
 
+  Lookups are made by --workers threads, limited to --rate requests per second overall.
+  Each distinct query is made once: results are kept in the --cache SQLite file, so a run
+  which is interrupted can simply be restarted and repeated queries cost nothing.  The
+  --json replay of an earlier brave_api.ndjson is looked up through an index file built
+  alongside it (brave_api.ndjson.idx) the first time, so it starts at once however large the
+  file; queries it doesn't have go to the cache, then the API if BRAVE_API_KEY is set, and
+  are otherwise left unrated.  The replay's ratings are also copied into the cache, for
+  refresh_ratings.py: those newly indexed, or all of them into a new cache.  Output lines are
+  written in input order.
+
+  To try this out without an API key, run ./brave_api_stub.py and
+    export BRAVE_API_URL=http://localhost:18099/res/v1/web/search BRAVE_API_KEY=x
+
 """
 
-T_SLEEP_MS = 100 # Avoid rate limiting from Brave search API
-MAX_RETRIES = 3
+T_SLEEP_MS = 100 # Avoid rate limiting from Brave search API: the default --rate is one per T_SLEEP_MS
 N_COLS = 8
 
-import re, sys, os, time, json, random
-import urllib.parse
+import sys, os
+import argparse
 #import fileinput
 import datetime
-import html
-import requests
 import gzip
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from brave_api import API_URL, build_query, get_rating_api, RatingCache, ReplayIndex, TokenBucket
 
-addr_pat = re.compile(r"^addr:(?:city|postcode|street)=(.+)$")
-#rate_pat = re.compile(r'"ratingValue": +(\d\.\d)') # No longer valid 2024-09-07
-rate_pat = re.compile(r"rated +(\d+(\.\d+)?) +of +5")
+parser = argparse.ArgumentParser(description="Append a rating and its timestamp to each line of the data file")
+parser.add_argument("csv_gz", help="Input, in the 8 column '<' delimited format")
+parser.add_argument("--json", help="Replay the results in this brave_api.ndjson rather than calling the API")
+parser.add_argument("--workers", type=int, default=4, help="Concurrent API requests")
+parser.add_argument("--rate", type=float, default=1000 / T_SLEEP_MS, help="Max. API requests per second")
+parser.add_argument("--cache", default="brave_cache.db", help="SQLite file of query => rating results")
+args = parser.parse_args()
 
-n_args = len(sys.argv)
-if n_args != 2 and n_args != 4:
-  print("Usage: {} input.csv.gz [--json api_output.json]".format(sys.argv[0]))
-  sys.exit(1)
+csv_gz = args.csv_gz
+
+def eprint(*args, **kwargs):
+  print(*args, file=sys.stderr, **kwargs)
 
-csv_gz = sys.argv[1]
+cache = RatingCache(args.cache)
 
-qr = {} # Query string to rating
-if len(sys.argv) == 4 and "--json" == sys.argv[2]:
-  with open(sys.argv[3]) as f:
-    for line in f:
-      line = line.strip()
-      obj = json.loads(line)
-      q = obj["query"]["original"]
-      qr[q] = None
-      mat = rate_pat.search(line)
-      if mat is not None:
-        rating = mat.group(1)
-        qr[q] = rating
-  #print(json.dumps(qr))
-  #sys.exit(0)
+replay = None
+if args.json is not None:
+  replay = ReplayIndex(args.json)
+  if replay.n_indexed > 0:
+    eprint("Indexed {} responses in {}".format(replay.n_indexed, args.json))
+  seed_from = 0 if cache.count() == 0 else replay.indexed_from
+  cache.put_many(replay.items(seed_from))
 
 out = None
+out_lock = threading.Lock()
 api_key = os.getenv("BRAVE_API_KEY")
-if qr is None and api_key is None:
+api_url = os.getenv("BRAVE_API_URL", API_URL)
+if replay is None and api_key is None:
   print("Environment variable BRAVE_API_KEY must be set. Quitting.")
   sys.exit(1)
 
-if qr is None:
+if api_key is not None:
   # Save all the JSON data here for future use (it costs a bit of $).
   out = open("brave_api.ndjson", 'a')
 
-def eprint(*args, **kwargs):
-  print(*args, file=sys.stderr, **kwargs)
-
-# Given an array of query terms, return the FLOAT value of its rating (1 - 5).
-def get_rating_api(q):
-  rv = None
-  q = urllib.parse.quote_plus(q)
-  hdrs = {
-    "Accept": "application/json"
-    , "Accept-Encoding": "gzip"
-    , "X-Subscription-Token": api_key
-  }
-  url = "https://api.search.brave.com/res/v1/web/search?q={}".format(q)
-  # See: https://requests.readthedocs.io/en/latest/user/advanced/,
-  # https://stackoverflow.com/questions/16511337/correct-way-to-try-except-using-python-requests-module
-  r = None
-  for x in range(0, MAX_RETRIES):
-    try:
-      r = requests.get(url, headers=hdrs, timeout=(0.93, 2.71))
-      break
-    except requests.exceptions.Timeout:
-      pass
-    except requests.exceptions.ConnectionError:
-      time.sleep(random.randint(50, 2000)/1000)
-  if r is None:
-    eprint("URL: {} returned None".format(url))
-    return rv
-  obj = r.json()
-  if out is not None:
-    out.write(json.dumps(obj) + '\n')
-  """
-  The "ratingValue" field occurs at various places:
-    $.web.results.0.location.rating.ratingValue
-    $.web.results.9.review.rating.ratingValue
-    rv = obj["web"]["results"][0]["location"]["rating"]["ratingValue"]
-    ... so just go with a regular expression:
-  """
-  mat = rate_pat.search(json.dumps(obj))
-  if mat is not None:
-    rv = mat.group(1)
-  return rv
-
-#for line in fileinput.input():
-with gzip.open(csv_gz, "rt") as f:
-  for line in f:
-    line = line.rstrip()
-    a = line.split('<')
-    if N_COLS != len(a):
-      continue
-    (id, dt, uid, lat, lon, name, kvagg, geohash) = a
-    terms = [name]
-    # Only need name and kvagg
-    for x in kvagg.split('|'):
-      if len(x) == 0:
-        continue;
-      x = html.unescape(x)
-      x = re.sub(r"['\",{}]", "", x)
-      m = addr_pat.match(x)
-      if m is not None:
-        terms.append(m.group(1))
-    q = ' '.join(terms)
-    rating = None
-    if qr:
-      rating = qr[q]
-    else:
-      rating = get_rating_api(q)
-    if rating is not None:
-      a.append(rating)
-      a.append(datetime.datetime.now().isoformat())
-    else:
-      a.append("")
-      a.append("")
-    print('<'.join(a))
-    if not qr:
-      time.sleep(T_SLEEP_MS/1000)
+bucket = TokenBucket(args.rate)
+
+# Runs in the worker threads
+def lookup(q):
+  bucket.acquire()
+  (ok, rating) = get_rating_api(q, api_key, api_url, out, out_lock)
+  if ok:
+    cache.put(q, rating)
+  return rating
+
+def emit(a, rating):
+  if rating is not None:
+    a.append(rating)
+    a.append(datetime.datetime.now().isoformat())
+  else:
+    a.append("")
+    a.append("")
+  print('<'.join(a))
+
+n_lines = 0
+n_api = 0
+n_cached = 0
+inflight = {} # Query => Future, so identical queries in flight are made once
+pending = deque() # (columns, query, rating or Future), in input order
+max_pending = 64 * args.workers
+
+def emit_first():
+  (a, q, res) = pending.popleft()
+  if isinstance(res, Future):
+    res = res.result()
+    inflight.pop(q, None)
+  emit(a, res)
+
+with ThreadPoolExecutor(max_workers=args.workers) as pool:
+  #for line in fileinput.input():
+  with gzip.open(csv_gz, "rt") as f:
+    for line in f:
+      line = line.rstrip()
+      a = line.split('<')
+      if N_COLS != len(a):
+        continue
+      n_lines += 1
+      (id, dt, uid, lat, lon, name, kvagg, geohash) = a
+      # Only need name and kvagg
+      q = build_query(name, kvagg)
+      (found, res) = (False, None)
+      if replay is not None:
+        (found, res) = replay.get(q)
+      if found:
+        n_cached += 1
+      else:
+        (found, res) = cache.get(q)
+        if found:
+          n_cached += 1
+        elif q in inflight:
+          res = inflight[q]
+        elif api_key is None:
+          res = None # Not in the replay, and no way to ask
+        else:
+          res = inflight[q] = pool.submit(lookup, q)
+          n_api += 1
+      pending.append((a, q, res))
+      # Write out whatever is ready, in order
+      while len(pending) > 0 and (len(pending) > max_pending
+          or not isinstance(pending[0][2], Future) or pending[0][2].done()):
+        emit_first()
+  while len(pending) > 0:
+    emit_first()
+
+eprint("Lines: {}, API requests: {}, cached: {}".format(n_lines, n_api, n_cached))
+cache.close()
+if replay is not None:
+  replay.close()
 if out is not None:
   out.close()
-
@@ -0,0 +1,241 @@
+"""
+  Rating lookups via the Brave search API, for add_ratings_to_data_file.py and refresh_ratings.py:
+
+  * build_query(): the search string for a row (its name plus address details)
+  * get_rating_api(): one API call, with retries
+  * TokenBucket: client side rate limit, shared by the threads making API calls
+  * RatingCache: persistent query -> rating store (SQLite), so a query is only paid for once
+  * ReplayIndex: query lookups in an earlier brave_api.ndjson, via an index file built once
+
+  Set BRAVE_API_URL to point the lookups at another server, e.g. brave_api_stub.py.
+"""
+
+import html
+import json
+import logging
+import mmap
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import urllib.parse
+import requests
+
+API_URL = "https://api.search.brave.com/res/v1/web/search"
+MAX_RETRIES = 3
+
+addr_pat = re.compile(r"^addr:(?:city|postcode|street)=(.+)$")
+#rate_pat = re.compile(r'"ratingValue": +(\d\.\d)') # No longer valid 2024-09-07
+rate_pat = re.compile(r"rated +(\d+(\.\d+)?) +of +5")
+
+# The search terms for a row of the data file: its name, then any city, postcode or street
+def build_query(name, kvagg):
+  terms = [name]
+  for x in kvagg.split('|'):
+    if len(x) == 0:
+      continue
+    x = html.unescape(x)
+    x = re.sub(r"['\",{}]", "", x)
+    m = addr_pat.match(x)
+    if m is not None:
+      terms.append(m.group(1))
+  return ' '.join(terms)
+
+"""
+  The "ratingValue" field occurs at various places:
+    $.web.results.0.location.rating.ratingValue
+    $.web.results.9.review.rating.ratingValue
+    rv = obj["web"]["results"][0]["location"]["rating"]["ratingValue"]
+    ... so just go with a regular expression:
+"""
+def rating_from_text(s):
+  mat = rate_pat.search(s)
+  if mat is not None:
+    return mat.group(1)
+  return None
+
+def get_rating_api(q, api_key, api_url=API_URL, out=None, out_lock=None):
+  """
+  Look up query string q.  Returns (ok, rating), where ok is True only for a 200 response
+  with a JSON body, and rating is a string (1 - 5) or None.  Any other outcome (no answer,
+  an error status, an HTML error page) is (False, None), not to be cached.  An ok response
+  is appended to the file out, if given, as one line of JSON (it costs a bit of $).
+  """
+  hdrs = {
+    "Accept": "application/json"
+    , "Accept-Encoding": "gzip"
+    , "X-Subscription-Token": api_key
+  }
+  url = "{}?q={}".format(api_url, urllib.parse.quote_plus(q))
+  # See: https://requests.readthedocs.io/en/latest/user/advanced/,
+  # https://stackoverflow.com/questions/16511337/correct-way-to-try-except-using-python-requests-module
+  r = None
+  for x in range(0, MAX_RETRIES):
+    try:
+      r = requests.get(url, headers=hdrs, timeout=(0.93, 2.71))
+      if r.status_code == 429: # Rate limited: back off and try again
+        time.sleep(float(r.headers.get("Retry-After", 1)))
+        r = None
+        continue
+      if r.status_code >= 500: # Maybe transient: try again
+        logging.warning("URL: {} returned {}".format(url, r.status_code))
+        time.sleep(random.randint(50, 2000)/1000)
+        r = None
+        continue
+      break
+    except requests.exceptions.Timeout:
+      pass
+    except requests.exceptions.ConnectionError:
+      time.sleep(random.randint(50, 2000)/1000)
+  if r is None:
+    logging.warning("URL: {} returned None".format(url))
+    return (False, None)
+  if r.status_code != 200:
+    logging.warning("URL: {} returned {}".format(url, r.status_code))
+    return (False, None)
+  try:
+    obj = r.json()
+  except ValueError: # Not JSON, e.g. a proxy's HTML error page
+    logging.warning("URL: {} returned a body which isn't JSON".format(url))
+    return (False, None)
+  s = json.dumps(obj)
+  if out is not None:
+    if out_lock is not None:
+      with out_lock:
+        out.write(s + '\n')
+    else:
+      out.write(s + '\n')
+  return (True, rating_from_text(s))
+
+class TokenBucket:
+  """ Allow rate acquire() calls per second on average, with bursts of up to burst calls """
+  def __init__(self, rate, burst=1):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = burst
+    self.t_last = time.monotonic()
+    self.lock = threading.Lock()
+  def acquire(self):
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.t_last) * self.rate)
+        self.t_last = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+        wait_s = (1 - self.tokens) / self.rate
+      time.sleep(wait_s)
+
+class RatingCache:
+  """
+  Query string -> rating, in a SQLite file.  A rating of None is stored too: it means the
+  query was made and had no rating, so it isn't repeated.  Safe to share between threads.
+  """
+  def __init__(self, path):
+    self.lock = threading.Lock()
+    self.conn = sqlite3.connect(path, check_same_thread=False)
+    self.conn.execute("PRAGMA journal_mode=WAL")
+    self.conn.execute("CREATE TABLE IF NOT EXISTS rating (query TEXT PRIMARY KEY, rating TEXT, ts TEXT)")
+    self.conn.commit()
+  # Returns (found, rating), ignoring any result more than max_age_days old
+  def get(self, q, max_age_days=None):
+    with self.lock:
+      if max_age_days is None:
+        row = self.conn.execute("SELECT rating FROM rating WHERE query = ?", (q,)).fetchone()
+      else:
+        row = self.conn.execute("SELECT rating FROM rating WHERE query = ? AND ts >= datetime('now', ?)",
+          (q, "-{} days".format(max_age_days))).fetchone()
+    if row is None:
+      return (False, None)
+    return (True, row[0])
+  def put(self, q, rating):
+    self.put_many([(q, rating)])
+  def count(self):
+    with self.lock:
+      return self.conn.execute("SELECT COUNT(*) FROM rating").fetchone()[0]
+  def put_many(self, query_ratings):
+    with self.lock:
+      self.conn.executemany("INSERT OR REPLACE INTO rating (query, rating, ts) VALUES (?, ?, datetime('now'))",
+        query_ratings)
+      self.conn.commit()
+  def close(self):
+    with self.lock:
+      self.conn.close()
+
+class ReplayIndex:
+  """
+  Look up queries in a brave_api.ndjson file (one API response per line) without reading it
+  all into memory.  The query -> (offset, length) index is kept in a SQLite file next to it,
+  built on first use and extended when lines have since been appended to the NDJSON; lookups
+  read just the one response, from a memory map of the file.  Where a query occurs more than
+  once, the last response wins.  indexed_from is the offset the last update() started at, so
+  items(indexed_from) are the responses it just indexed.
+  """
+  def __init__(self, ndjson_path, index_path=None):
+    self.path = ndjson_path
+    self.conn = sqlite3.connect(index_path or ndjson_path + ".idx")
+    self.conn.execute("CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v INTEGER)")
+    self.conn.execute("CREATE TABLE IF NOT EXISTS response (query TEXT PRIMARY KEY, off INTEGER, len INTEGER)")
+    self.n_indexed = self.update()
+    self.f = open(ndjson_path, "rb")
+    self.mm = None
+    if os.path.getsize(ndjson_path) > 0:
+      self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+
+  # Index any lines not yet indexed; returns how many there were
+  def update(self, batch_size=10000):
+    size = os.path.getsize(self.path)
+    row = self.conn.execute("SELECT v FROM meta WHERE k = 'size'").fetchone()
+    start = row[0] if row is not None else 0
+    if start > size: # Not the file that was indexed: start over
+      self.conn.execute("DELETE FROM response")
+      start = 0
+    self.indexed_from = start
+    if start == size:
+      return 0
+    n = 0
+    batch = []
+    with open(self.path, "rb") as f:
+      f.seek(start)
+      off = start
+      for line in f:
+        if not line.endswith(b"\n"):
+          break # A partly written last line; index it next time
+        text = line.strip()
+        if len(text) > 0:
+          q = json.loads(text)["query"]["original"]
+          batch.append((q, off, len(line)))
+          n += 1
+        off += len(line)
+        if len(batch) >= batch_size:
+          self.conn.executemany("INSERT OR REPLACE INTO response (query, off, len) VALUES (?, ?, ?)", batch)
+          batch = []
+    self.conn.executemany("INSERT OR REPLACE INTO response (query, off, len) VALUES (?, ?, ?)", batch)
+    self.conn.execute("INSERT OR REPLACE INTO meta (k, v) VALUES ('size', ?)", (off,))
+    self.conn.commit()
+    return n
+
+  # Returns (found, rating)
+  def get(self, q):
+    row = self.conn.execute("SELECT off, len FROM response WHERE query = ?", (q,)).fetchone()
+    if row is None or self.mm is None:
+      return (False, None)
+    (off, length) = row
+    return (True, rating_from_text(self.mm[off:off + length].decode("utf8")))
+
+  # Yields (query, rating) for each response indexed at offset min_off or beyond
+  def items(self, min_off=0):
+    if self.mm is None:
+      return
+    for (q, off, length) in self.conn.execute("SELECT query, off, len FROM response WHERE off >= ? ORDER BY off",
+        (min_off,)).fetchall():
+      yield (q, rating_from_text(self.mm[off:off + length].decode("utf8")))
+
+  def close(self):
+    if self.mm is not None:
+      self.mm.close()
+    self.f.close()
+    self.conn.close()
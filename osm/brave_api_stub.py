@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+"""
+  A stand-in for the Brave search API, for trying out add_ratings_to_data_file.py without
+  an API key (or spending any money).  Each query gets a made up, but repeatable, rating
+  (or none, for about a quarter of them), in a response shaped like the real one.
+
+    $ ./brave_api_stub.py --port 18099 --max-rps 20 &
+    $ export BRAVE_API_URL=http://localhost:18099/res/v1/web/search BRAVE_API_KEY=x
+    $ ./add_ratings_to_data_file.py osm_with_city.txt.gz | gzip - > osm_with_ratings.txt.gz
+
+  --max-rps makes it answer 429, as the real API does, when requests arrive too quickly.
+"""
+
+import argparse
+import hashlib
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+parser = argparse.ArgumentParser(description="Stub of the Brave search API")
+parser.add_argument("--port", type=int, default=18099)
+parser.add_argument("--max-rps", type=float, help="Answer 429 above this many requests per second")
+parser.add_argument("--delay-ms", type=float, default=0, help="Added latency per request")
+args = parser.parse_args()
+
+lock = threading.Lock()
+stats = { "requests": 0, "rate_limited": 0, "window_start": time.time(), "window_count": 0 }
+
+def fake_response(q):
+  h = int(hashlib.sha1(q.encode("utf8")).hexdigest(), 16)
+  results = [{ "title": q, "url": "https://example.com/{}".format(h % 100000), "description": "No rating here" }]
+  if h % 4 != 0:
+    rating = (h % 7 + 3) / 2 # 1.5 .. 4.5
+    results.append({ "title": q, "description": "{} is rated {} of 5 by 123 reviewers".format(q, rating) })
+  return { "type": "search", "query": { "original": q }, "web": { "results": results } }
+
+class Handler(BaseHTTPRequestHandler):
+  def log_message(self, format, *args):
+    pass
+  def do_GET(self):
+    with lock:
+      stats["requests"] += 1
+      now = time.time()
+      if now - stats["window_start"] >= 1.0:
+        stats["window_start"] = now
+        stats["window_count"] = 0
+      stats["window_count"] += 1
+      limited = args.max_rps is not None and stats["window_count"] > args.max_rps
+      if limited:
+        stats["rate_limited"] += 1
+    if limited:
+      self.send_response(429)
+      self.send_header("Retry-After", "1")
+      self.end_headers()
+      return
+    if args.delay_ms > 0:
+      time.sleep(args.delay_ms / 1000)
+    params = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+    body = json.dumps(fake_response(params.get("q", [""])[0])).encode("utf8")
+    self.send_response(200)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+server = ThreadingHTTPServer(("127.0.0.1", args.port), Handler)
+print("Listening on port {}".format(args.port))
+try:
+  server.serve_forever()
+except KeyboardInterrupt:
+  pass
+print("Requests: {}, rate limited: {}".format(stats["requests"], stats["rate_limited"]))
@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 
-import sys, json
+import sys, os, json
+
+# geo_util.py lives alongside load_osm_stdin.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import geo_util
 
 # Based on output from this UI: https://geojson.io/
 
@@ -21,23 +25,7 @@ import sys, json
             ...
 """
 
-top = -1000
-left = 1000
-bottom = left
-right = top
-
 obj = json.load(sys.stdin)
-for latlon in obj["features"][0]["geometry"]["coordinates"][0]:
-  lat = latlon[1]
-  if lat > top:
-    top = lat
-  if lat < bottom:
-    bottom = lat
-  lon = latlon[0]
-  if lon < left:
-    left = lon
-  if lon > right:
-    right = lon
+(top, left, bottom, right) = geo_util.coords_bbox(obj["features"][0]["geometry"]["coordinates"][0])
 
 print("  --bounding-box top={} left={} bottom={} right={}".format(top, left, bottom, right))
-
@@ -4,26 +4,33 @@
 
 import psycopg2
 import psycopg2.errorcodes
+import psycopg2.extras
 
 import sqlalchemy
-from sqlalchemy import create_engine, insert
-from sqlalchemy import Table, MetaData
+from sqlalchemy import create_engine
 
 import time
 import sys, os
 import re
+import random
 import csv
+import sqlite3
+import tempfile
 import logging
-import pygeohash as pgh
-from bloom_filter2 import BloomFilter
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# geo_util.py lives alongside load_osm_stdin.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import geo_util
 
 """
  $ sudo apt install python3-pip
  $ pip3 install psycopg2-binary
  $ pip3 install sqlalchemy
  $ pip3 install sqlalchemy-cockroachdb
- $ pip3 install bloom-filter2
- $ pip3 install pygeohash
+ $ pip3 install numpy
 """
 
 logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(message)s", datefmt="%m/%d/%Y %I:%M:%S %p")
@@ -47,18 +54,29 @@ logging.info("MAX_RETRIES: {}".format(max_retries))
 
 db_url = re.sub(r"^postgres", "cockroachdb", db_url)
 logging.info("DB_CONN_STR (rewritten): {}".format(db_url))
-engine = create_engine(db_url, pool_pre_ping=True)
+n_writers = int(os.getenv("N_WRITERS", "4")) # Concurrent INSERTs, each on its own connection
+engine = create_engine(db_url, pool_pre_ping=True, pool_size=n_writers)
 logging.info("Engine: OK")
 
-osm_names_table = Table("osm_names", MetaData(), autoload_with=engine)
+# The osm_names columns, in the order of the input file, then the geohashes
+osm_names_cols = ["name", "alternative_names", "osm_type", "osm_id", "osm_class", "the_type", "lon", "lat",
+  "place_rank", "importance", "street", "city", "county", "state", "country", "country_code", "display_name",
+  "west", "south", "east", "north", "wikidata", "wikipedia", "geohash5", "geohash6", "geohash7"]
+n_input_cols = 23
+float_cols = (6, 7, 17, 18, 19, 20) # Input columns which must be numbers: lon, lat, west, south, east, north
+
+# One multi-row INSERT per batch; a row already loaded (e.g. by an earlier, interrupted run) is
+# skipped, not an error
+insert_sql = "INSERT INTO osm_names ({}) VALUES %s ON CONFLICT DO NOTHING".format(", ".join(osm_names_cols))
+insert_template = "({})".format(", ".join(["%s"] * len(osm_names_cols)))
 
-def do_inserts(list_of_row_maps):
+def do_inserts(rows):
   for retry in range(1, max_retries + 1):
     try:
       with engine.begin() as conn:
-        # https://docs.sqlalchemy.org/en/14/tutorial/data_insert.html
-        conn.execute(insert(osm_names_table), list_of_row_maps)
-      return
+        with conn.connection.cursor() as cur:
+          psycopg2.extras.execute_values(cur, insert_sql, rows, template=insert_template, page_size=len(rows))
+      return len(rows)
     except sqlalchemy.exc.OperationalError as e: # This handles dead nodes
       logging.warning(e)
       logging.warning("OperationalError: sleeping 5 seconds")
@@ -68,108 +86,156 @@ def do_inserts(list_of_row_maps):
       sleep_s = (2 ** retry) * 0.1 * (random.random() + 0.5)
       logging.warning("Sleeping %s seconds", sleep_s)
       time.sleep(sleep_s)
-    except (sqlalchemy.exc.IntegrityError, psycopg2.errors.UniqueViolation) as e:
-      logging.warning(e)
-      logging.warning("UniqueViolation: continuing to next TXN")
     except psycopg2.Error as e:
       logging.warning(e)
       logging.warning("Not sure about this one ... sleeping 5 seconds, though")
       time.sleep(5)
+  raise Exception("INSERT did not succeed after {} retries".format(max_retries))
 
-rows_per_batch = 1024
+rows_per_batch = int(os.getenv("ROWS_PER_BATCH", "1024"))
 n_rows_ins = 0 # Rows inserted
 n_line = 0 # Position in input file
-n_batch = 1
-float_re = re.compile(r"^-?\d+\.\d+$")
+n_bad = 0 # Lines rejected
+n_batch = 0
 got_hdr = None
 
-bloom = BloomFilter(max_elements=10500000, error_rate=0.01)
-row_list = []
-tsv = csv.reader(sys.stdin, delimiter='\t', quotechar='"')
-for row in tsv:
-  # Skip the header
-  if not got_hdr:
-    got_hdr = True
-    continue
-  n_line += 1
-
-  # Verify that columns containing lat / lon values are indeed FLOATs
-  floats_ok = True
-  for i in (6, 7, 17, 18, 19, 20):
-    if not float_re.match(row[i]):
-      print("Line {}: failed to match FLOAT '{}'".format(n_line, row[i]))
-      floats_ok = False
-  if not floats_ok:
-    continue
-
-  # Convert any empty string values to None
-  for i in range(0, len(row)):
-    if len(row[i]) == 0:
-      row[i] = None
-
-  try:
-    # 7 => lat, 6 => lon
-    geohash = pgh.encode(float(row[7]), float(row[6]))
-  except Exception as e:
-    print(e)
-    continue
-
-  row_map = {
-    "name": row[0],
-    "alternative_names": row[0] + ' ' + '' if row[1] is None else ' '.join(re.split(r',\s*', row[1])),
-    "osm_type": row[2],
-    "osm_id": row[3],
-    "osm_class": row[4],
-    "the_type": row[5],
-    "lon": row[6],
-    "lat": row[7],
-    "place_rank": row[8],
-    "importance": row[9],
-    "street": row[10],
-    "city": row[11],
-    "county": row[12],
-    "state": row[13],
-    "country": row[14],
-    "country_code": row[15],
-    "display_name": row[16],
-    "west": row[17],
-    "south": row[18],
-    "east": row[19],
-    "north": row[20],
-    "wikidata": row[21],
-    "wikipedia": row[22],
-    "geohash5": geohash[:5],
-    "geohash6": geohash[:6],
-    "geohash7": geohash[:7]
-  }
-
-  # Ensure all components of the PK are present
-  if row_map["name"] is None or row_map["city"] is None:
-    continue
-
-  # Use a Bloom filter keyed by the PK components to avoid dupe rows
-  #  PRIMARY KEY (geohash5, geohash7, city, name)
-  pk = geohash[:7] + row_map["name"] + row_map["city"]
-  if pk in bloom:
-    print("{} already seen -- skipping".format(pk))
-    continue
-  else:
-    bloom.add(pk)
-
-  row_list.append(row_map)
-
-  if len(row_list) % rows_per_batch == 0:
-    print("Running INSERT for batch %d of %d rows" % (n_batch, rows_per_batch))
-    t0 = time.time()
-    do_inserts(row_list)
-    n_rows_ins += len(row_list)
-    row_list.clear()
-    t1 = time.time()
-    print("INSERT for batch %d of %d rows took %.2f s" % (n_batch, rows_per_batch, t1 - t0))
-    n_batch += 1
+n_dups = 0 # Rows skipped as duplicates
+
+class SeenKeys:
+  """
+  The set of primary keys seen so far in this run, in a temporary SQLite file rather than in
+  memory, so it's exact and its size isn't limited by RAM.  A key is added when its row is
+  converted, before it's inserted, so the set isn't kept: a rerun after an interrupted or
+  failed load starts with an empty one, and relies on the INSERT's ON CONFLICT DO NOTHING to
+  skip the rows which were loaded.
+  """
+  def __init__(self):
+    self.tmp = tempfile.NamedTemporaryFile(prefix="geonames_keys_", suffix=".db")
+    self.conn = sqlite3.connect(self.tmp.name)
+    # Thrown away at the end of the run, so it needn't survive a crash
+    self.conn.execute("PRAGMA journal_mode=OFF")
+    self.conn.execute("PRAGMA synchronous=OFF")
+    self.conn.execute("PRAGMA cache_size=-65536") # 64 MB
+    self.conn.execute("CREATE TABLE IF NOT EXISTS seen (k TEXT PRIMARY KEY) WITHOUT ROWID")
+  # Returns a list of True / False, for whether each of keys is new; and adds the new ones
+  def add_batch(self, keys):
+    found = set()
+    uniq = list(set(keys))
+    for i in range(0, len(uniq), 500): # Below SQLite's limit on bound parameters
+      part = uniq[i:i + 500]
+      sql = "SELECT k FROM seen WHERE k IN ({})".format(','.join('?' * len(part)))
+      found.update(r[0] for r in self.conn.execute(sql, part))
+    rv = []
+    new = set()
+    for k in keys:
+      is_new = k not in found and k not in new
+      if is_new:
+        new.add(k)
+      rv.append(is_new)
+    self.conn.executemany("INSERT INTO seen (k) VALUES (?)", [(k,) for k in new])
+    self.conn.commit()
+    return rv
+  def close(self):
+    self.conn.close()
+    self.tmp.close()
+
+seen = SeenKeys()
 
-# Last bit
-if len(row_list) > 0:
-  do_inserts(row_list)
-  n_rows_ins += len(row_list) 
+float_re = re.compile(r"^-?\d+\.\d+$")
 
+def float_column(values):
+  """
+  The values of one column of a batch as a float64 array, with NaN where a value doesn't
+  match float_re (so "5", "1e5" or " 5.0 " are rejected, though float() would take them).
+  The matching values are converted in one go.
+  """
+  ok = [float_re.match(v) is not None for v in values]
+  if all(ok):
+    return np.array(values, dtype=np.float64)
+  return np.array([v if m else "nan" for (v, m) in zip(values, ok)], dtype=np.float64)
+
+def to_rows(lines):
+  """
+  Convert a batch of input rows (lists of strings) to tuples in osm_names_cols order, a
+  column at a time: the number columns are converted to floats in bulk, rows with a bad
+  one or with no name or city are dropped, as are rows already seen.
+  """
+  global n_bad, n_dups
+  n = len(lines)
+  lines = [a for a in lines if len(a) >= n_input_cols]
+  n_bad += n - len(lines)
+  if len(lines) == 0:
+    return []
+  cols = list(zip(*lines))
+  floats = {i: float_column(cols[i]) for i in float_cols}
+  ok = np.ones(len(lines), dtype=bool)
+  for a in floats.values():
+    ok &= np.isfinite(a)
+  ok &= np.array([len(name) > 0 and len(city) > 0 for (name, city) in zip(cols[0], cols[11])])
+  n_bad += int(len(lines) - ok.sum())
+  if not ok.all():
+    idx = np.flatnonzero(ok)
+    cols = [[c[i] for i in idx] for c in cols]
+    floats = {i: a[idx] for (i, a) in floats.items()}
+  if len(cols[0]) == 0:
+    return []
+  geohashes = geo_util.encode(floats[7], floats[6], 7).tolist()
+
+  # Skip rows whose PK components have been seen already
+  #  PRIMARY KEY (geohash5, geohash6, geohash7, city, name): geohash7 determines the other two
+  is_new = seen.add_batch(["{}\t{}\t{}".format(g, city, name) for (g, city, name) in zip(geohashes, cols[11], cols[0])])
+  n_dups += len(is_new) - sum(is_new)
+
+  # Empty strings are NULLs; the number columns are floats
+  out = []
+  for i in range(n_input_cols):
+    if i in (6, 7):
+      out.append(floats[i].tolist()) # The lon and lat columns are FLOAT; the rest are TEXT
+    elif i == 1:
+      out.append([name + ' ' if len(alt) == 0 else ' '.join(re.split(r',\s*', alt)) for (name, alt) in zip(cols[0], cols[1])])
+    else:
+      out.append([v if len(v) > 0 else None for v in cols[i]])
+  out.append([g[:5] for g in geohashes])
+  out.append([g[:6] for g in geohashes])
+  out.append(geohashes)
+  return [r for (r, new) in zip(zip(*out), is_new) if new]
+
+t_start = time.time()
+def report():
+  dt = time.time() - t_start
+  logging.info("Lines: {}, inserted: {} ({:.0f} rows/s), duplicates: {}, rejected: {}".format(n_line, n_rows_ins,
+    n_rows_ins / dt if dt > 0 else 0, n_dups, n_bad))
+
+with ThreadPoolExecutor(max_workers=n_writers) as pool:
+  # At most 2 batches per writer are held in memory
+  pending = deque()
+  def submit(lines):
+    global n_rows_ins, n_batch
+    rows = to_rows(lines)
+    if len(rows) > 0:
+      pending.append(pool.submit(do_inserts, rows))
+    while len(pending) >= 2 * n_writers:
+      n_rows_ins += pending.popleft().result()
+    n_batch += 1
+    if n_batch % 100 == 0:
+      report()
+  lines = []
+  tsv = csv.reader(sys.stdin, delimiter='\t', quotechar='"')
+  for row in tsv:
+    # Skip the header
+    if not got_hdr:
+      got_hdr = True
+      continue
+    n_line += 1
+    lines.append(row)
+    if len(lines) == rows_per_batch:
+      submit(lines)
+      lines = []
+  # Last bit
+  if len(lines) > 0:
+    submit(lines)
+  while len(pending) > 0:
+    n_rows_ins += pending.popleft().result()
+
+seen.close()
+report()
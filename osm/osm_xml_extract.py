@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+
+"""
+  Extract the named nodes from OSM XML extracts, using an incremental XML parser rather
+  than matching lines with regular expressions, so attribute order and formatting don't
+  matter and memory use doesn't grow with the size of the input.
+
+  Output formats (on stdout):
+    * json:   one object per line, as osm_xml_to_json_no_db.py prints
+    * txt:    the 8 column '<' delimited format of extract_points_from_osm_xml.pl, which is
+              the input to add_city.pl and add_ratings_to_data_file.py
+    * loader: the 10 column format load_osm_stdin.py reads (rating columns left empty)
+
+  Inputs may be plain, .gz or .bz2 files.  With --workers > 1, each input is split into
+  ranges of about --block-mb which are parsed in parallel:
+    * plain XML files split anywhere
+    * .bz2 files split at stream boundaries, so this needs a multi-stream file such as those
+      written by pbzip2 or lbzip2 (osmosis ... | pbzip2 > extract.osm.bz2); a single stream
+      file is one range
+    * .gz files aren't split
+  and several input files are processed in parallel too.  Each top level element belongs to
+  the range in which it starts, so elements spanning a boundary are parsed exactly once.
+
+  Examples:
+
+    $ ./osm_xml_extract.py --format loader --workers 8 extracted.osm.bz2 | gzip - > osm_eu.txt.gz
+    $ ./osm_xml_extract.py --format json --max-points 5000000 extracted.osm.bz2 > osm.ndjson
+"""
+
+import argparse
+import bz2
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import re
+import sys
+import xml.etree.ElementTree as ET
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from xml.sax.saxutils import escape
+
+# osm_format.py and geo_util.py live alongside load_osm_stdin.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import geo_util
+from osm_format import COL_SEP, KV_SEP, format_line, geohash_prefixes
+
+# Start of a top level element; and that or the end of the document
+start_re = re.compile(rb"<(?:node|way|relation)[\s>/]")
+top_re = re.compile(rb"<(?:node|way|relation)[\s>/]|</osm>")
+# Start of a bzip2 stream: "BZh", block size, then the block header magic
+bz2_stream_re = re.compile(rb"BZh[1-9]1AY&SY")
+
+# How the OSM XML escapes attribute values; the '<' delimited formats keep values escaped
+xml_entities = { '"': "&quot;", "'": "&apos;" }
+
+def iter_nodes(f):
+  """
+  Yield (attrib, tags) for each <node> having at least one tag, from a binary file object.
+  Elements are cleared as soon as they've been read, so memory use is bounded.
+  """
+  context = ET.iterparse(f, events=("start", "end"))
+  (event, root) = next(context)
+  for (event, elem) in context:
+    if event != "end":
+      continue
+    if elem.tag == "node":
+      tags = {}
+      for t in elem.iter("tag"):
+        tags[t.get('k')] = t.get('v')
+      if len(tags) > 0:
+        yield (elem.attrib, tags)
+    if elem.tag in ("node", "way", "relation"):
+      root.clear()
+
+def iter_named_batches(f, batch_size=4096):
+  """
+  Yield lists of (attrib, tags, geohash) for the nodes having a name, batch_size at a time,
+  so the geohashes can be computed for a whole batch at once
+  """
+  batch = []
+  for (attrib, tags) in iter_nodes(f):
+    if "name" in tags:
+      batch.append((attrib, tags))
+      if len(batch) >= batch_size:
+        yield with_geohashes(batch)
+        batch = []
+  if batch:
+    yield with_geohashes(batch)
+
+def with_geohashes(batch):
+  geohashes = geo_util.encode([float(a["lat"]) for (a, t) in batch], [float(a["lon"]) for (a, t) in batch])
+  return [(a, t, g) for ((a, t), g) in zip(batch, geohashes.tolist())]
+
+def node_to_dict(attrib, tags, geohash):
+  node = {}
+  for k in ("id", "version", "timestamp", "uid", "user", "changeset"):
+    node[k] = attrib.get(k)
+  lat = float(attrib["lat"])
+  lon = float(attrib["lon"])
+  node["lat"] = lat
+  node["lon"] = lon
+  # Add some geohash values.  The "20km" suffix means it's accurate to +/- 20 kilometers
+  node["geo_20m"] = geohash[0:8]
+  node["geo_2400m"] = geohash[0:5]
+  node["geo_20km"] = geohash[0:4]
+  node["geo_80km"] = geohash[0:3]
+  node["kv"] = tags
+  return node
+
+def node_to_txt(attrib, tags, geohash, n_cols):
+  lat = attrib["lat"]
+  lon = attrib["lon"]
+  kv = []
+  for (k, v) in tags.items():
+    if k == "name":
+      continue
+    kv.append(escape(re.sub(r"[|=]", '~', k), xml_entities) + '=' + escape(re.sub(r"[|=]", '~', v), xml_entities))
+  name = escape(tags["name"], xml_entities)
+  if n_cols == 8:
+    return COL_SEP.join([attrib["id"], attrib.get("timestamp", ""), attrib.get("uid", ""), lat, lon, name,
+      KV_SEP.join(kv + geohash_prefixes(geohash)), geohash])
+  return format_line(attrib["id"], attrib.get("timestamp", ""), attrib.get("uid", ""), lat, lon, name, kv, geohash)
+
+def format_node(fmt, attrib, tags, geohash):
+  if fmt == "json":
+    return json.dumps(node_to_dict(attrib, tags, geohash))
+  return node_to_txt(attrib, tags, geohash, 8 if fmt == "txt" else 10)
+
+# Only nodes with a name are of interest
+def extract(f, fmt):
+  for batch in iter_named_batches(f):
+    for (attrib, tags, geohash) in batch:
+      yield format_node(fmt, attrib, tags, geohash)
+
+def open_input(path):
+  if path.endswith(".bz2"):
+    return bz2.open(path, "rb")
+  if path.endswith(".gz"):
+    return gzip.open(path, "rb")
+  return open(path, "rb")
+
+#
+# Ranges, for the parallel mode
+#
+
+# The decompressed data of each bz2 stream from f's current position, as (offset, data)
+def iter_bz2_streams(f, read_size=1 << 20):
+  pos = f.tell()
+  d = bz2.BZ2Decompressor()
+  out = []
+  data = f.read(read_size)
+  data_end = f.tell() # File offset just past data
+  while data:
+    out.append(d.decompress(data))
+    if d.eof:
+      # What's left over is the start of the next stream
+      data = d.unused_data
+      yield (pos, b''.join(out))
+      pos = data_end - len(data)
+      d = bz2.BZ2Decompressor()
+      out = []
+      if data:
+        continue
+    data = f.read(read_size)
+    data_end = f.tell()
+  if out:
+    yield (pos, b''.join(out)) # Truncated final stream
+
+# The data in the "units" starting at or after offset, as (offset, data): bz2 streams, or blocks of a plain file
+def iter_units(path, offset, block_size):
+  with open(path, "rb") as f:
+    f.seek(offset)
+    if path.endswith(".bz2"):
+      yield from iter_bz2_streams(f)
+      return
+    while True:
+      data = f.read(block_size)
+      if not data:
+        return
+      yield (offset, data)
+      offset += len(data)
+
+# The offset of the first unit which starts in [start, end), or None
+def first_unit(path, start, end):
+  if not path.endswith(".bz2"):
+    return start
+  with open(path, "rb") as f:
+    f.seek(start)
+    # Overlap the reads so a header spanning two of them is found
+    buf = b''
+    base = start
+    while base < end:
+      data = f.read(1 << 20)
+      if not data:
+        return None
+      buf = buf[-9:] + data
+      m = bz2_stream_re.search(buf)
+      if m is not None:
+        at = base - (len(buf) - len(data)) + m.start()
+        return at if at < end else None
+      base += len(data)
+  return None
+
+def parse_range(task):
+  """
+  Parse the elements which start in the units beginning in [start, end) of a file, reading
+  on into following units just far enough to finish the last of them.  Returns the output
+  lines as one string.
+  """
+  (path, start, end, fmt, block_size) = task
+  offset = first_unit(path, start, end)
+  if offset is None:
+    return (0, '')
+  owned = []
+  tail = b''
+  units = iter_units(path, offset, block_size)
+  for (pos, data) in units:
+    if pos >= end:
+      tail = data
+      break
+    owned.append(data)
+  owned = b''.join(owned)
+  stop = owned.find(b"</osm>")
+  if stop >= 0:
+    (owned, tail) = (owned[:stop], None)
+  m = start_re.search(owned)
+  if m is None:
+    return (0, '')
+  # Finish the last element, from the following units
+  while tail is not None:
+    t = top_re.search(tail)
+    if t is not None:
+      tail = tail[:t.start()]
+      break
+    more = next(units, None)
+    if more is None:
+      break
+    tail += more[1]
+  doc = io.BytesIO(b"<osm>" + owned[m.start():] + (tail or b'') + b"</osm>")
+  lines = list(extract(doc, fmt))
+  return (len(lines), '\n'.join(lines) + '\n' if lines else '')
+
+def make_tasks(paths, fmt, workers, block_size):
+  for path in paths:
+    if workers <= 1 or path.endswith(".gz"):
+      yield (path, None, None, fmt, block_size)
+      continue
+    size = os.path.getsize(path)
+    # A single stream bz2 file can't be split; pbzip2 streams are well under 1 MB
+    if path.endswith(".bz2") and first_unit(path, 1, min(size, 64 << 20)) is None:
+      yield (path, None, None, fmt, block_size)
+      continue
+    for start in range(0, size, block_size):
+      yield (path, start, min(start + block_size, size), fmt, block_size)
+
+def run_task(task):
+  (path, start, end, fmt, block_size) = task
+  if start is None:
+    with open_input(path) as f:
+      lines = list(extract(f, fmt))
+    return (len(lines), '\n'.join(lines) + '\n' if lines else '')
+  return parse_range(task)
+
+def main():
+  parser = argparse.ArgumentParser(description="Extract named nodes from OSM XML files")
+  parser.add_argument("files", nargs='+', help="OSM XML files (plain, .gz or .bz2)")
+  parser.add_argument("--format", choices=["json", "txt", "loader"], default="json")
+  parser.add_argument("--workers", type=int, default=1, help="Parser processes")
+  parser.add_argument("--block-mb", type=float, default=16, help="Size of the ranges parsed in parallel, in MB")
+  parser.add_argument("--max-points", type=int, help="Stop after this many nodes")
+  args = parser.parse_args()
+
+  out = sys.stdout
+  n_out = 0
+  if args.workers <= 1:
+    # Stream straight through, one file after another
+    for path in args.files:
+      with open_input(path) as f:
+        for line in extract(f, args.format):
+          out.write(line + '\n')
+          n_out += 1
+          if args.max_points is not None and n_out >= args.max_points:
+            return
+    return
+
+  block_size = int(args.block_mb * (1 << 20))
+  ctx = multiprocessing.get_context("fork")
+  with ProcessPoolExecutor(max_workers=args.workers, mp_context=ctx) as pool:
+    # Keep the output in input order, holding at most 2 ranges per worker in memory
+    pending = deque()
+    def drain_one():
+      (n, text) = pending.popleft().result()
+      if args.max_points is not None and n_out + n > args.max_points:
+        text = ''.join(text.splitlines(True)[:args.max_points - n_out])
+        n = args.max_points - n_out
+      out.write(text)
+      return n
+    for task in make_tasks(args.files, args.format, args.workers, block_size):
+      pending.append(pool.submit(run_task, task))
+      while len(pending) >= 2 * args.workers:
+        n_out += drain_one()
+        if args.max_points is not None and n_out >= args.max_points:
+          for fut in pending:
+            fut.cancel()
+          return
+    while len(pending) > 0 and (args.max_points is None or n_out < args.max_points):
+      n_out += drain_one()
+
+if __name__ == "__main__":
+  main()
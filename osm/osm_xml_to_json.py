@@ -4,8 +4,7 @@
 
   * Generate a geohash of the (lat, lon)
   * Add the geohash and some shortened versions to the JSON (See https://github.com/vinsci/geohash/)
-    - pip3 install Geohash
-    - geohash = Geohash.encode(lat, lon)
+    - geohashes come from geo_util.encode(), a batch of nodes at a time
     - geohash precision: https://gis.stackexchange.com/questions/115280/what-is-the-precision-of-a-geohash
   * Store entire record as JSONB
   * Index the JSONB
@@ -15,9 +14,17 @@
     - https://whatpub.com/
 
   * ./osm_xml_to_json.py extracted.osm.bz2 5000000  5567.39s user 28.17s system 6% cpu 25:15:00.26 total
+    (that was the line-by-line regex version; nodes now come from osm_xml_extract.iter_nodes())
   * cockroach dump defaultdb osm_json --insecure  279.00s user 61.36s system 179% cpu 3:10.11 total
   * gzip - > backup.sql.gz  57.24s user 1.92s system 31% cpu 3:10.11 total
 
+  * Rows are written by N_WRITERS threads (default 4), each with its own connection, as
+    multi-row INSERTs of PAGE_SIZE rows (default 500) from batches of BATCH_SIZE (default 5000).
+    The inverted index on obj is created once the load is done, which is much faster than
+    maintaining it row by row:
+
+    CREATE INVERTED INDEX IF NOT EXISTS osm_json_obj_idx ON osm_json (obj);
+
   * DDL:
 
     DROP TABLE IF EXISTS osm_json;
@@ -36,14 +43,15 @@
 import sys
 import os
 import json
-import bz2
-import re
-import Geohash
+import random
+import threading
 import psycopg2
 import psycopg2.errorcodes
 import psycopg2.extras
-import html
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from osm_xml_extract import iter_named_batches, node_to_dict, open_input
 
 # Example input data
 """
@@ -72,82 +80,106 @@ if len(sys.argv) != 3:
 in_file = sys.argv[1]
 max_points = int(sys.argv[2])
 
-conn = psycopg2.connect(
-  database=os.getenv("PGDATABASE", "defaultdb")
-  , user=os.getenv("PGUSER", "root")
-  , port=int(os.getenv("PGPORT", "26257"))
-  , host=os.getenv("PGHOST", "localhost")
-  , application_name="OSM JSON"
-)
-conn.autocommit = True
+batch_size = int(os.getenv("BATCH_SIZE", "5000"))
+page_size = int(os.getenv("PAGE_SIZE", "500"))
+n_writers = int(os.getenv("N_WRITERS", "4"))
+max_retries = int(os.getenv("MAX_RETRIES", "5"))
+
+def connect():
+  conn = psycopg2.connect(
+    database=os.getenv("PGDATABASE", "defaultdb")
+    , user=os.getenv("PGUSER", "root")
+    , port=int(os.getenv("PGPORT", "26257"))
+    , host=os.getenv("PGHOST", "localhost")
+    , application_name="OSM JSON"
+  )
+  conn.autocommit = True
+  return conn
+
+def setup_db(conn):
+  with conn.cursor() as cur:
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS osm_json
+    (
+      id STRING
+      , geo_20km CHAR(4)
+      , ts TIMESTAMP
+      , x GEOGRAPHY
+      , obj JSONB
+      ,  PRIMARY KEY (geo_20km ASC, id ASC)
+    );
+    """)
+
+# Each writer thread keeps its own connection
+local = threading.local()
+
+# ON CONFLICT DO NOTHING makes retrying a partly written batch safe
+insert_sql = "INSERT INTO osm_json (id, geo_20km, ts, x, obj) VALUES %s ON CONFLICT DO NOTHING"
+insert_template = "(%s, %s, %s, ST_MakePoint(%s, %s)::GEOGRAPHY, %s::JSONB)"
 
 # rows is a list of lists
-def do_inserts (conn, rows):
+def do_inserts(rows):
   t0 = time.time()
-  with conn.cursor() as cur:
-    """
-    psycopg2.extras.execute_batch(cur, "INSERT INTO osm_json (id, geo_20km, ts, x, obj)"
-      + "VALUES (%s, %s, %s, ST_MakePoint(%s, %s)::GEOGRAPHY, %s::JSONB)",
-      rows, page_size=100)
-    """
-  print("INSERTED %d rows in %.2f seconds" % (len(rows), time.time() - t0))
+  for retry in range(1, max_retries + 1):
+    try:
+      if getattr(local, "conn", None) is None:
+        local.conn = connect()
+      with local.conn.cursor() as cur:
+        psycopg2.extras.execute_values(cur, insert_sql, rows, template=insert_template, page_size=page_size)
+      print("INSERTED %d rows in %.2f seconds" % (len(rows), time.time() - t0))
+      return len(rows)
+    except psycopg2.errors.SerializationFailure as e:
+      print(e)
+      sleep_s = (2 ** retry) * 0.1 * (random.random() + 0.5)
+      print("Sleeping %.2f seconds" % sleep_s)
+      time.sleep(sleep_s)
+    except (psycopg2.OperationalError, psycopg2.InterfaceError) as e: # This handles dead nodes
+      print(e)
+      print("Reconnecting in 5 seconds")
+      local.conn = None
+      time.sleep(5)
+  raise ValueError("INSERT did not succeed after %d retries" % max_retries)
+
+conn = connect()
+setup_db(conn)
 
 n_read = 0
-kv = {}
-node = {}
-batch_size = 1000
-
-# See above data examples for how this is derived
-node_pat = re.compile(r'<node id="([^"]+)" version="(\d+)" timestamp="([^"]+)" uid="(\d+)" user="([^"]+)" changeset="(\d+)" lat="(-?\d+\.\d+)" lon="(-?\d+\.\d+)">')
-tag_pat = re.compile(r'^<tag +k="([^"]+)" +v="([^"]+)" */>$')
-
+n_ins = 0
+t_start = time.time()
 rows = []
-with bz2.open(in_file, mode="rt", encoding="utf8", newline='\n') as f:
-  while n_read < max_points:
-    line = f.readline().strip()
-    if line.startswith("</node>"):
-      if not bool(node) or not bool(kv): # Is either empty?
-        continue
-      if "name" in kv: # I think it's interesting only is it has a name
-        node["kv"] = kv
+with ThreadPoolExecutor(max_workers=n_writers) as pool:
+  # At most 2 batches per writer are held in memory
+  pending = deque()
+  def submit(rows):
+    global n_ins
+    pending.append(pool.submit(do_inserts, rows))
+    while len(pending) >= 2 * n_writers:
+      n_ins += pending.popleft().result()
+  with open_input(in_file) as f:
+    # Only the nodes with a name: I think it's interesting only is it has a name
+    for batch in iter_named_batches(f):
+      for (attrib, tags, geohash) in batch:
+        node = node_to_dict(attrib, tags, geohash)
         rows.append([node["id"], node["geo_20km"], node["timestamp"], node["lon"], node["lat"], json.dumps(node)])
         if len(rows) == batch_size:
-          do_inserts(conn, rows)
+          submit(rows)
           rows = []
-        #print(json.dumps(node))
         n_read += 1
-    elif line.startswith("<node "):
-      if line.endswith("/>"):
-        continue
-      node.clear()
-      kv.clear()
-      m = node_pat.match(line)
-      if m is not None:
-        node["id"] = m.group(1)
-        node["version"] = m.group(2)
-        node["timestamp"] = m.group(3)
-        node["uid"] = m.group(4)
-        node["user"] = html.unescape(m.group(5))
-        node["changeset"] = m.group(6)
-        lat = float(m.group(7))
-        lon = float(m.group(8))
-        node["lat"] = lat
-        node["lon"] = lon
-        geohash = Geohash.encode(lat, lon)
-        # Add some geohash values.  The "20km" suffix means it's accurate to +/- 20 kilometers
-        node["geo_20m"] = geohash[0:8]
-        node["geo_2400m"] = geohash[0:5]
-        node["geo_20km"] = geohash[0:4]
-        node["geo_80km"] = geohash[0:3]
-      else:
-        pass
-    elif line.startswith("<tag "):
-      m = tag_pat.match(line)
-      if m is not None:
-        kv[m.group(1)] = html.unescape(str(m.group(2)))
-      else:
-        pass
-if len(rows) > 0:
-  do_inserts(conn, rows)
+        if n_read >= max_points:
+          break
+      if n_read >= max_points:
+        break
+  if len(rows) > 0:
+    submit(rows)
+  while len(pending) > 0:
+    n_ins += pending.popleft().result()
+
+t_load = time.time() - t_start
+print("Loaded %d rows in %.1f seconds (%.0f rows/s)" % (n_ins, t_load, n_ins / max(t_load, 1e-6)))
+
+t0 = time.time()
+with conn.cursor() as cur:
+  print("Creating inverted index on obj")
+  cur.execute("CREATE INVERTED INDEX IF NOT EXISTS osm_json_obj_idx ON osm_json (obj);")
+print("Index created in %.1f seconds" % (time.time() - t0))
 conn.close()
-
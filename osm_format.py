@@ -0,0 +1,139 @@
+"""
+  Definitions shared by the scripts which produce or consume the '<' delimited OSM data
+  files (see load_osm_stdin.py and osm/extract_points_from_osm_xml.pl).  Each line has
+  these columns:
+
+    id<date_time<uid<lat<lon<name<key_value<geohash<rating<rating_ts
+
+  where key_value is a '|' separated list of k=v tags, followed by the 3 to 6 character
+  prefixes of the geohash; e.g.
+
+    262714<2018-12-07T09:55:55Z<917436<51.0359<-0.805651<Rising Sun<addr:city=Liphook|amenity=pub|gcp|gcp6|gcp6m|gcp6md<gcp6mdv3dvr1<4.5<2024-02-08T10:11:12.131415
+"""
+
+import html
+import re
+
+N_COLS = 10 # Number of columns in the input data set
+COL_SEP = '<' # Illegal in the XML, so safe to use as delimiter
+KV_SEP = '|'
+
+# This is the list of sites where our "tourist" will initially appear upon a page load
+sites = []
+sites.append({"name": "British Museum", "lat": 51.519844, "lon": -0.126731})
+sites.append({"name": "Trafalgar Square", "lat": 51.506712, "lon": -0.127235})
+sites.append({"name": "Tate Modern", "lat": 51.508337, "lon": -0.099281})
+sites.append({"name": "Dublin", "lat": 53.346028, "lon": -6.279658})
+sites.append({"name": "Munich", "lat": 48.135056, "lon": 11.576097})
+sites.append({"name": "Le Marais", "lat": 48.857744, "lon": 2.357768})
+sites.append({"name": "Trastevere", "lat": 41.886071, "lon": 12.467422})
+sites.append({"name": "Prado Museum", "lat": 40.41367, "lon": -3.69185})
+sites.append({"name": "Mercado Antón Martín", "lat": 40.41170, "lon": -3.69850})
+sites.append({"name": "Kyiv", "lat": 50.4474203, "lon": 30.5265874})
+sites.append({"name": "Austin", "lat": 30.260721, "lon": -97.747101})
+sites.append({"name": "Charlottesville", "lat": 38.0311977, "lon": -78.4829433})
+sites.append({"name": "Madison Square Park", "lat": 40.742348, "lon": -73.988355})
+sites.append({"name": "Dupont Circle", "lat": 38.9100535, "lon": -77.0426321})
+sites.append({"name": "Laguna Beach", "lat": 33.5418456, "lon": -117.7838984})
+sites.append({"name": "Westwood", "lat": 34.0620851, "lon": -118.4428635})
+sites.append({"name": "Pasadena", "lat": 34.1390904, "lon": -118.1277370})
+sites.append({"name": "Orlando", "lat": 28.5458843, "lon": -81.3760205})
+
+# Append the 3 to 6 character prefixes of the geohash to a list of k=v tags
+def geohash_prefixes(geohash):
+  return [geohash[:i] for i in range(3, 7)]
+
+# Format one line of the data file; lat and lon are already strings, as are rating and rating_ts
+# ("" if there is no rating).
+def format_line(id, dt, uid, lat, lon, name, tags, geohash, rating="", rating_ts=""):
+  kvagg = KV_SEP.join(tags + geohash_prefixes(geohash))
+  return COL_SEP.join([str(id), dt, str(uid), lat, lon, name, kvagg, geohash, rating, rating_ts])
+
+#
+# Parsing, for load_osm_stdin.py.  This runs once per input line, so it avoids regular
+# expressions wherever a string method will do, binds everything it calls to a local name,
+# and returns a tuple in OSM_COLS order rather than a dict.
+#
+
+# Column order of the tuples returned by parse_line()
+OSM_COLS = ("geohash4", "amenity", "id", "date_time", "uid", "name", "lat", "lon",
+  "key_value", "search_hints", "rating", "rating_ts")
+
+# (lat, lon) may have this format: 54°05.131'..., which is bogus
+llre = re.compile(r"^-?\d+\.\d+$")
+# Words in the name
+word_re = re.compile(r"\w+")
+# Use any of these entities as search_hints
+addr_pat = re.compile(r"^addr:(?:city|postcode|street)=(.+)$")
+# Characters dropped from the tags
+strip_re = re.compile(r"['\",{}]")
+
+def parse_line(line, _N_COLS=N_COLS, _ll_match=llre.match, _words=word_re.findall, _addr_match=addr_pat.match,
+  _unescape=html.unescape, _strip_search=strip_re.search, _strip_sub=strip_re.sub):
+  """
+  Parse one line of the data file into a tuple in OSM_COLS order, or return None if the line
+  is malformed.  Lines such as "N rows: 1000", printed by the Perl extract script, have the
+  wrong number of columns so they are skipped here too.
+  """
+  a = line.rstrip().split(COL_SEP)
+  if len(a) != _N_COLS:
+    return None
+  (id, dt, uid, lat, lon, name, kvagg, geohash, rating, rating_ts) = a
+  if _ll_match(lat) is None or _ll_match(lon) is None:
+    return None
+  # Start with the words in the name
+  kv = _words(name.lower())
+  amenity = ""
+  search_hints = []
+  for x in kvagg.split(KV_SEP):
+    if not x:
+      continue
+    if '&' in x:
+      x = _unescape(x)
+    if _strip_search(x) is not None:
+      x = _strip_sub("", x)
+    kv.append(x)
+    if x.startswith("amenity"):
+      amenity = x.split('=')[1]
+    # Location details: postcode, street, city
+    # Example: addr:postcode=GU27 3HA|addr:street=Midhurst Road
+    elif x.startswith("addr:"):
+      m = _addr_match(x)
+      if m is not None:
+        search_hints.append(m.group(1))
+  if '&' in name:
+    name = _unescape(name)
+  return (geohash[:4], amenity, id, dt, uid, name, lat, lon, kv, ' '.join(search_hints),
+    rating or None, rating_ts or None)
+
+# The array literal for a list of strings, e.g. {"pub","addr:city=Liphook"}
+def pg_array(a):
+  return '{' + ','.join('"' + x.replace('\\', '\\\\').replace('"', '\\"') + '"' for x in a) + '}'
+
+# Parse a chunk of whole lines (bytes, as read by read_chunks()); returns (n_lines, rows).
+# This is what the worker processes run in the loader's pipeline mode.  Sending the rows
+# back to the parent process is much cheaper when they are flat tuples of strings, so
+# key_value is rendered as an array literal here rather than left as a list.
+def parse_chunk(data):
+  rows = []
+  kv_idx = OSM_COLS.index("key_value")
+  # Split on b'\n' only, as the serial path's lines are: str.splitlines() would also split on
+  # '\r', '\x85', '\u2028' etc., which can be in a name
+  lines = data.split(b'\n')
+  if len(lines) > 0 and len(lines[-1]) == 0:
+    lines.pop()
+  for line in lines:
+    row = parse_line(line.decode("utf8", "replace"))
+    if row is not None:
+      rows.append(row[:kv_idx] + (pg_array(row[kv_idx]),) + row[kv_idx + 1:])
+  return (len(lines), rows)
+
+# Split a binary stream into chunks of about chunk_bytes, each ending on a line boundary
+def read_chunks(f, chunk_bytes):
+  while True:
+    data = f.read(chunk_bytes)
+    if not data:
+      return
+    if not data.endswith(b'\n'):
+      data += f.readline()
+    yield data
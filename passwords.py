@@ -0,0 +1,74 @@
+"""
+  Password hashing and checking in a pool of worker processes, off the request threads.
+
+  Werkzeug's hashes are slow on purpose, and hold the GIL while they run, so a burst of logins
+  or signups done inline would take the threads and the core /features needs.  HashPool runs
+  them in max_workers processes instead and admits at most max_workers + max_queued at once;
+  beyond that, PoolBusy is raised at once (map_app.py answers 503, with Retry-After), so a
+  request thread never queues behind the pool for long.
+
+  PASSWORD_HASH_METHOD sets the method and cost of new hashes, in Werkzeug's format (e.g.
+  "scrypt:32768:8:1" or "pbkdf2:sha256:600000"); a stored hash made another way is replaced
+  when its owner next logs in (see needs_rehash()).
+"""
+
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from werkzeug.security import generate_password_hash, check_password_hash
+
+class PoolBusy(Exception):
+  pass
+
+class HashPool:
+  def __init__(self, method="scrypt", max_workers=2, max_queued=4, timeout_s=10):
+    self.method = method
+    self.max_workers = max_workers
+    self.timeout_s = timeout_s
+    self.slots = threading.BoundedSemaphore(max_workers + max_queued)
+    self.lock = threading.Lock()
+    self.pool = None
+    self.prefix = None
+
+  # Started on first use, so importing the app doesn't start processes.  The workers are
+  # spawned rather than forked, so they don't inherit the app's threads or connections.
+  def _get_pool(self):
+    with self.lock:
+      if self.pool is None:
+        self.pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+      return self.pool
+
+  def _run(self, fn, *args):
+    if not self.slots.acquire(blocking=False):
+      raise PoolBusy()
+    try:
+      f = self._get_pool().submit(fn, *args)
+    except Exception:
+      self.slots.release()
+      raise
+    # The slot is held until the work is done, even if this request gives up waiting
+    f.add_done_callback(lambda f: self.slots.release())
+    try:
+      return f.result(timeout=self.timeout_s)
+    except TimeoutError:
+      raise PoolBusy()
+
+  def hash(self, password):
+    return self._run(generate_password_hash, password, self.method)
+
+  def check(self, pwhash, password):
+    if pwhash is None:
+      return False
+    return self._run(check_password_hash, pwhash, password)
+
+  def needs_rehash(self, pwhash):
+    if self.prefix is None:
+      # The method as it's written at the start of a hash, with the defaults filled in
+      self.prefix = self.hash("").split('$', 1)[0]
+    return pwhash is not None and pwhash.split('$', 1)[0] != self.prefix
+
+  def shutdown(self):
+    with self.lock:
+      if self.pool is not None:
+        self.pool.shutdown()
+        self.pool = None
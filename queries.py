@@ -0,0 +1,119 @@
+"""
+  The SQL of the app's hot statements, as run by map_app.py with text(...).bindparams(...), in
+  a module of its own so check_query_plans.py can EXPLAIN exactly the same statements without
+  starting the app.
+"""
+
+# The top 10 nearest features of an amenity, within 5 km of (:lat_val, :lon_val).  With
+# use_geohash, :cells are the geohash4 cells covering the circle (geo_util.cover_circle()) and
+# :amenity the amenity, so it reads the primary key's (geohash4, amenity) prefixes; otherwise
+# it's the osm_geo_idx index, and :amenity is 'amenity=<amenity>'.
+def features_sql(use_geohash):
+  sql = """
+  WITH q1 AS
+  (
+    SELECT
+      name,
+      ST_Distance(ST_MakePoint(:lon_val, :lat_val)::GEOGRAPHY, ref_point)::NUMERIC(9, 2) dist_m,
+      ST_Y(ref_point::GEOMETRY) lat,
+      ST_X(ref_point::GEOMETRY) lon,
+      rating,
+      geohash4,
+      id
+    FROM osm
+    WHERE
+  """
+  if use_geohash:
+    # The 5 km circle can reach into neighboring geohash4 cells too
+    sql += "geohash4 = ANY (:cells) AND amenity = :amenity"
+  else:
+    sql += "ST_DWithin(ST_MakePoint(:lon_val, :lat_val)::GEOGRAPHY, ref_point, 5.0E+03, TRUE)"
+    sql += " AND key_value && ARRAY[:amenity]"
+  sql += """
+  )
+  SELECT * FROM q1
+  """
+  if use_geohash:
+    sql += "WHERE dist_m < 5.0E+03"
+  sql += """
+  ORDER BY dist_m ASC
+  LIMIT 10;
+  """
+  return sql
+
+# The user and role names in one query
+user_sql = """
+SELECT t.id, t.username, r.name
+FROM tourist t
+LEFT JOIN tourist_role tr ON tr.tourist_id = t.id
+LEFT JOIN "role" r ON r.id = tr.role_id
+WHERE t.id = :id
+"""
+
+sites_sql = """
+SELECT lat, lon
+FROM tourist_locations
+WHERE enabled = TRUE
+ORDER BY RANDOM()
+LIMIT 1;
+"""
+
+upsert_position_sql = """
+UPSERT INTO tourist_position (geohash5, time_bucket, tourist_id, username, ts, lat, lon)
+VALUES (:geohash5, :time_bucket, :tourist_id, :username, :ts, :lat, :lon)
+"""
+
+# The latest position of each tourist seen in the cells and time buckets covering the query
+nearby_sql = """
+SELECT DISTINCT ON (tourist_id) tourist_id, username, lat, lon, ts
+FROM tourist_position
+WHERE geohash5 = ANY (:cells) AND time_bucket >= :min_bucket AND ts >= :min_ts AND tourist_id != :me
+ORDER BY tourist_id, ts DESC
+"""
+
+# A tourist's route: compacted points from way_point_trail, then the raw ones still in way_point.
+# Both are read by their (tourist_id, ts) primary keys, and compaction keeps both bounded.
+trail_sql = """
+SELECT ts, lat, lon FROM way_point_trail WHERE tourist_id = :me AND ts >= :min_ts
+UNION ALL
+SELECT ts, lat, lon FROM way_point WHERE tourist_id = :me AND ts >= :min_ts
+ORDER BY ts
+LIMIT :max_points
+"""
+
+amenity_sql = """
+SELECT name, lat, lon, rating
+FROM osm
+WHERE geohash4 = :geohash4 AND amenity = :amenity AND id = :id;
+"""
+
+edit_sql = """
+UPDATE osm SET rating = :rating, name = :name
+WHERE geohash4 = :geohash4 AND amenity = :amenity AND id = :id
+RETURNING geohash4, amenity, id, name, rating, lat, lon
+"""
+
+# One UPDATE for n_rows edits, bound as :g<i>, :a<i>, :i<i> (the row's key), :sr<i>, :r<i>
+# (whether to set the rating, and to what) and :sn<i>, :n<i> (the same for the name); with
+# regional, also :region, the crdb_region of all the rows
+def bulk_update_sql(n_rows, regional=False):
+  values = ", ".join("(:g{0}, :a{0}, CAST(:i{0} AS INT8), :sr{0}, CAST(:r{0} AS FLOAT8), :sn{0}, CAST(:n{0} AS TEXT))".format(i)
+    for i in range(n_rows))
+  sql = """
+  UPDATE osm SET
+    rating = CASE WHEN v.set_rating THEN v.rating ELSE osm.rating END,
+    name = CASE WHEN v.set_name THEN v.name ELSE osm.name END
+  FROM (VALUES {}) AS v (geohash4, amenity, id, set_rating, rating, set_name, name)
+  WHERE osm.geohash4 = v.geohash4 AND osm.amenity = v.amenity AND osm.id = v.id
+  """.format(values)
+  if regional:
+    sql += " AND osm.crdb_region = :region"
+  sql += " RETURNING osm.geohash4, osm.amenity, osm.id, osm.name, osm.rating, osm.lat, osm.lon"
+  return sql
+
+def bulk_update_params(edits):
+  params = {}
+  for (i, edit) in enumerate(edits):
+    for (k, v) in zip(("g", "a", "i", "sr", "r", "sn", "n"), edit):
+      params[k + str(i)] = v
+  return params